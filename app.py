@@ -1,15 +1,38 @@
 import streamlit as st
 import pandas as pd
-from datetime import datetime
+import numpy as np
+from datetime import datetime, timedelta
 import os
-from io import BytesIO
+import csv
+import fcntl
+import sqlite3
+import hashlib
+import threading
+import queue
+import atexit
+import time
+import uuid
+import bisect
+import unicodedata
+import tempfile
+import shutil
+import functools
+import zipfile
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from openpyxl import Workbook
 from streamlit_quill import st_quill
 import re
 import html
+import json
+from html.parser import HTMLParser
 import base64
 import textwrap
 import streamlit.components.v1 as components
-from PIL import Image, ImageDraw, ImageFont
+from streamlit.runtime.scriptrunner import add_script_run_ctx
+from PIL import Image, ImageDraw, ImageFont, ImageOps
 from urllib.parse import urlparse
 
 st.set_page_config(layout="wide")
@@ -57,15 +80,44 @@ h1, h2, h3 { font-weight: 800; }
 # =========================================================
 # 🔒 STORAGE PERSISTENTE RENDER — MOUNT: /var/dati
 # =========================================================
-DATA_DIR = "/var/data"
-UPLOAD_DIR = "/var/data/uploads"
+DATA_DIR = os.environ.get("DATA_DIR", "/var/data")
+UPLOAD_DIR = os.path.join(DATA_DIR, "uploads")
+IMG_CACHE_DIR = os.path.join(DATA_DIR, "img_cache")
+IMG_CACHE_MAX_BYTES = int(os.environ.get("IMG_CACHE_MAX_MB", "200")) * 1024 * 1024
+DIAG_DIR = os.path.join(DATA_DIR, "diagnostica")
+# file di export preparati per il download: eliminati dopo EXPORT_MAX_ORE
+EXPORT_DIR = os.path.join(DATA_DIR, "export")
+EXPORT_MAX_ORE = float(os.environ.get("EXPORT_MAX_ORE", "6"))
+RERUN_LENTI_FILE = os.path.join(DIAG_DIR, "rerun_lenti.jsonl")
+RERUN_LENTO_S = float(os.environ.get("RERUN_LENTO_S", "1.0"))
 
 if not os.path.exists(UPLOAD_DIR):
     os.makedirs(UPLOAD_DIR)
 
-LOG_FILE = "/var/data/log.csv"
-MSG_FILE = "/var/data/messaggi.csv"
-PDV_FILE = "/var/data/pdv.csv"
+LOG_FILE = os.path.join(DATA_DIR, "log.csv")
+LOG_DIR = os.path.join(DATA_DIR, "log")
+MSG_FILE = os.path.join(DATA_DIR, "messaggi.csv")
+PDV_FILE = os.path.join(DATA_DIR, "pdv.csv")
+GRUPPI_FILE = os.path.join(DATA_DIR, "gruppi.csv")
+ELIMINATI_FILE = os.path.join(DATA_DIR, "messaggi_eliminati.csv")
+DB_FILE = os.path.join(DATA_DIR, "operativita.db")
+
+# "csv" (default) oppure "sqlite"
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "csv")
+
+PDV_COLS = ["pdv_id", "pdv_nome"]
+MSG_COLS = ["msg", "inizio", "fine", "pdv_ids", "file", "id", "hash"]
+# calcolati al salvataggio (deriva_msg) e salvati accanto al messaggio
+MSG_DERIVATI = ["titolo", "testo", "link", "card"]
+# pdv: nome del PDV al momento del check-in (storico leggibile);
+# pdv_id: chiave per deduplica, copertura e filtri (vuoto nelle righe
+# storiche non ricondotte a un PDV esistente)
+LOG_COLS = ["data", "pdv", "msg", "pdv_id"]
+FORMATO_DATA_LOG = "%d-%m-%Y %H:%M:%S"
+# gruppi di PDV con nome, usabili come destinatari (@NOME)
+GRUPPI_COLS = ["gruppo", "pdv_ids"]
+# messaggi eliminati: il log cita l'id, titolo e date restano qui
+ELIMINATI_COLS = ["id", "titolo", "inizio", "fine", "eliminato"]
 
 HOME_URL = "https://eu.jotform.com/it/app/build/253605296903360"
 
@@ -133,30 +185,298 @@ div[data-testid="stFileUploader"] p {
 # =========================================================
 # UTILS
 # =========================================================
-def load_csv(path, cols):
-    if os.path.exists(path):
-        return pd.read_csv(path, dtype=str).fillna("")
-    return pd.DataFrame(columns=cols)
+class DataCache:
+    # DataFrame letti dai CSV, condivisi da tutte le sessioni del processo.
+    # Ogni voce è valida finché la firma del file (inode, mtime, size) non
+    # cambia; i DataFrame restituiti vanno trattati in sola lettura.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._path_locks = {}
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path, cols, converti=None):
+        # converti: DataFrame letto -> DataFrame tenuto in cache (es. tipizza_log)
+        sig = file_signature(path)
+        if sig is None:
+            df = pd.DataFrame(columns=cols)
+            return converti(df) if converti else df
+        with self._lock:
+            path_lock = self._path_locks.setdefault(path, threading.Lock())
+        # un solo parse per file anche con molte sessioni in attesa
+        with path_lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == sig:
+                with self._lock:
+                    self.hits += 1
+                return entry[1]
+            if path.endswith(".parquet"):
+                df = pd.read_parquet(path)
+            else:
+                df = pd.read_csv(path, dtype=str)
+            df = converti(df) if converti else df.fillna("")
+            self._entries[path] = (sig, df)
+            with self._lock:
+                self.misses += 1
+            return df
+
+    def invalida(self, path):
+        with self._lock:
+            self._entries.pop(path, None)
+
+    def stats(self):
+        with self._lock:
+            return {"hit": self.hits, "miss": self.misses, "file": len(self._entries)}
+
+
+@st.cache_resource(show_spinner=False)
+def get_data_cache():
+    return DataCache()
+
+
+class Metriche:
+    # tempi per fase (ultimi N campioni) e contatori, condivisi tra le sessioni
+    def __init__(self, finestra=1000):
+        self._lock = threading.Lock()
+        self.finestra = finestra
+        self.tempi = {}
+        self.contatori = {}
+        self.dal = now_str()
+
+    def registra(self, fase, dt):
+        with self._lock:
+            if fase not in self.tempi:
+                self.tempi[fase] = deque(maxlen=self.finestra)
+            self.tempi[fase].append(dt)
+            self.contatori[fase] = self.contatori.get(fase, 0) + 1
+
+    def conta(self, nome, n=1):
+        with self._lock:
+            self.contatori[nome] = self.contatori.get(nome, 0) + n
+
+    def riepilogo(self) -> pd.DataFrame:
+        with self._lock:
+            tempi = {k: list(v) for k, v in self.tempi.items()}
+        righe = []
+        for fase, v in sorted(tempi.items()):
+            q = pd.Series(v).quantile([0.5, 0.9, 0.99]) * 1000
+            righe.append([fase, len(v), q[0.5], q[0.9], q[0.99], max(v) * 1000])
+        return pd.DataFrame(righe, columns=["fase", "campioni", "p50 ms", "p90 ms", "p99 ms", "max ms"])
+
+    def azzera(self):
+        with self._lock:
+            self.tempi.clear()
+            self.contatori.clear()
+            self.dal = now_str()
+
+
+@st.cache_resource(show_spinner=False)
+def get_metriche():
+    return Metriche()
+
+
+# fasi del rerun in corso: ogni sessione gira nel proprio thread
+_rerun = threading.local()
+
+
+@contextmanager
+def timed(fase):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dt = time.perf_counter() - t0
+        get_metriche().registra(fase, dt)
+        fasi = getattr(_rerun, "fasi", None)
+        if fasi is not None:
+            fasi[fase] = fasi.get(fase, 0.0) + dt
+
+
+@contextmanager
+def rerun_misurato(pagina):
+    # tempo dell'intero rerun; quelli lenti finiscono in RERUN_LENTI_FILE
+    _rerun.fasi = {}
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dt = time.perf_counter() - t0
+        fasi, _rerun.fasi = _rerun.fasi, None
+        get_metriche().registra(f"rerun {pagina}", dt)
+        if dt >= RERUN_LENTO_S:
+            get_metriche().conta("rerun lenti")
+            riga = {
+                "ts": datetime.now().isoformat(timespec="milliseconds"),
+                "pagina": pagina,
+                "totale_s": round(dt, 4),
+                "fasi_s": {k: round(v, 4) for k, v in fasi.items()},
+            }
+            os.makedirs(DIAG_DIR, exist_ok=True)
+            with open(RERUN_LENTI_FILE, "a", encoding="utf-8") as f:
+                f.write(json.dumps(riga) + "\n")
+
+
+def load_csv(path, cols, converti=None):
+    with timed("load_csv"):
+        return get_data_cache().load(path, cols, converti)
+
+
+@contextmanager
+def file_lock(path):
+    # lock esclusivo su file ".lock" accanto ai dati: serializza
+    # append e riscritture tra sessioni (thread) e processi
+    with open(path + ".lock", "a") as lf:
+        fcntl.flock(lf, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lf, fcntl.LOCK_UN)
 
 
 def save_csv(df, path):
-    df.to_csv(path, index=False)
+    # scrittura su file temporaneo + rename atomico, sotto lock
+    with timed("save_csv"), file_lock(path):
+        tmp = path + ".tmp"
+        df.to_csv(tmp, index=False)
+        os.replace(tmp, path)
+        get_data_cache().invalida(path)
 
 
-def now_str():
-    return datetime.now().strftime("%d-%m-%Y %H:%M:%S")
+def save_parquet(df, path):
+    # archivio colonnare compresso, stessa scrittura atomica di save_csv
+    with timed("save_parquet"), file_lock(path):
+        tmp = path + ".tmp"
+        df.to_parquet(tmp, index=False, compression="zstd")
+        os.replace(tmp, path)
+        get_data_cache().invalida(path)
+
+
+def remove_file(path):
+    with file_lock(path):
+        if os.path.exists(path):
+            os.remove(path)
+        get_data_cache().invalida(path)
 
 
-def excel_bytes(df):
-    out = BytesIO()
-    with pd.ExcelWriter(out, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False)
-    return out.getvalue()
+def intestazione_csv(path) -> list[str]:
+    with open(path, newline="", encoding="utf-8") as f:
+        return next(csv.reader(f), [])
+
+
+def append_csv_rows(path, rows, cols):
+    # aggiunge righe in coda senza rileggere/riscrivere il file: una sola
+    # scrittura e un solo fsync per tutto il lotto
+    with file_lock(path):
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        with open(path, "a", newline="", encoding="utf-8") as f:
+            w = csv.writer(f, lineterminator="\n")
+            if new_file:
+                w.writerow(cols)
+            w.writerows(rows)
+            f.flush()
+            os.fsync(f.fileno())
+        get_data_cache().invalida(path)
+
+
+def file_signature(path):
+    # identità + versione di un file: cambia a ogni riscrittura/append
+    try:
+        st_ = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st_.st_ino, st_.st_mtime_ns, st_.st_size)
+
+
+def now_str():
+    return datetime.now().strftime(FORMATO_DATA_LOG)
 
 
 def normalize_lines(text: str) -> str:
     return text or ""
 
+
+def nuovo_id_msg() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+def hash_msg(html_msg: str) -> str:
+    return hashlib.sha256((html_msg or "").encode("utf-8")).hexdigest()[:16]
+
+
+def mese_log(data: str) -> str:
+    # "dd-mm-YYYY HH:MM:SS" -> "YYYY-MM", la partizione del log
+    d = data or ""
+    if len(d) >= 10 and d[6:10].isdigit() and d[3:5].isdigit():
+        return f"{d[6:10]}-{d[3:5]}"
+    return "0000-00"
+
+
+def mesi_log(date: pd.Series) -> pd.Series:
+    # colonna data tipizzata -> "YYYY-MM" ("0000-00" se mancante)
+    n = (date.dt.year * 100 + date.dt.month).fillna(0).astype(int)
+    return n.map({x: f"{x // 100:04d}-{x % 100:02d}" for x in n.unique()})
+
+
+def giorno_log(data: str):
+    # "dd-mm-YYYY HH:MM:SS" -> date (None se non valida)
+    try:
+        return datetime.strptime((data or "")[:10], "%d-%m-%Y").date()
+    except ValueError:
+        return None
+
+
+# ----- schema del log in memoria: data datetime64, pdv e msg categoriali,
+# ----- indice intero = id riga. Su disco (CSV, SQLite) resta testo.
+def tipizza_log(df: pd.DataFrame) -> pd.DataFrame:
+    # accetta righe testuali (CSV, SQLite) o già tipizzate (parquet)
+    data = df["data"]
+    if not pd.api.types.is_datetime64_any_dtype(data):
+        testo = data.fillna("").astype(str)
+        data = pd.to_datetime(testo, format=FORMATO_DATA_LOG, errors="coerce")
+        altre = data.isna() & (testo != "")
+        if altre.any():
+            # righe storiche in altri formati (es. senza ora)
+            data[altre] = pd.to_datetime(testo[altre], format="mixed", dayfirst=True, errors="coerce")
+    out = {"data": data}
+    for c in ("pdv", "msg", "pdv_id"):
+        # pdv_id manca nelle partizioni scritte prima della colonna
+        col = df[c] if c in df else pd.Series("", index=df.index)
+        out[c] = col if isinstance(col.dtype, pd.CategoricalDtype) else col.fillna("").astype(str).astype("category")
+    return pd.DataFrame(out, index=df.index)
+
+
+def formatta_data_log(data: pd.Series) -> pd.Series:
+    if pd.api.types.is_datetime64_any_dtype(data):
+        return data.dt.strftime(FORMATO_DATA_LOG).fillna("")
+    return data
+
+
+def testo_log(df: pd.DataFrame) -> pd.DataFrame:
+    # ritorno al formato su disco
+    return pd.DataFrame({
+        "data": formatta_data_log(df["data"]),
+        "pdv": df["pdv"].astype(str),
+        "msg": df["msg"].astype(str),
+        "pdv_id": df["pdv_id"].astype(str),
+    }, index=df.index)
+
+
+def split_ids(text: str) -> list[str]:
+    # una voce per riga (accettati anche "," e ";")
+    return [x.strip() for x in re.split(r"[\r\n,;]+", text or "") if x.strip()]
+
+
+def iso_data(s: str) -> str:
+    # "dd-mm-YYYY[ HH:MM:SS]" -> "YYYY-mm-dd[ HH:MM:SS]" (ordinabile)
+    try:
+        if len(s or "") > 10:
+            return datetime.strptime(s, "%d-%m-%Y %H:%M:%S").strftime("%Y-%m-%d %H:%M:%S")
+        return datetime.strptime(s, "%d-%m-%Y").strftime("%Y-%m-%d")
+    except (TypeError, ValueError):
+        return ""
+
 def strip_html_to_text(s: str) -> str:
     s = s or ""
     s = re.sub(r"<br\s*/?>", "\n", s, flags=re.IGNORECASE)
@@ -173,39 +493,69 @@ def first_line_title(html_msg: str) -> str:
     return txt.splitlines()[0].strip() or "SENZA TITOLO"
 
 
-def stato_msg(inizio: str, fine: str) -> str:
-    try:
-        di = datetime.strptime(inizio, "%d-%m-%Y").date()
-        df = datetime.strptime(fine, "%d-%m-%Y").date()
-        oggi = datetime.now().date()
-        return "ATTIVO" if di <= oggi <= df else "CHIUSO"
-    except Exception:
-        return ""
+def stato_messaggi(msg_df: pd.DataFrame, oggi=None) -> pd.Series:
+    # stato per messaggio: ATTIVO / CHIUSO / "" se date non valide
+    oggi = pd.Timestamp(oggi or datetime.now().date())
+    di = pd.to_datetime(msg_df["inizio"], format="%d-%m-%Y", errors="coerce")
+    df = pd.to_datetime(msg_df["fine"], format="%d-%m-%Y", errors="coerce")
+    stato = ((di <= oggi) & (oggi <= df)).map({True: "ATTIVO", False: "CHIUSO"})
+    return stato.where(di.notna() & df.notna(), "")
+
+
+def build_log_report(log: pd.DataFrame, msg_df: pd.DataFrame, oggi=None, primo=1, eliminati=None, indice=None) -> pd.DataFrame:
+    # titolo e stato calcolati una volta per messaggio distinto, poi mappati
+    # sulle righe del log; date confrontate per colonna
+    stato = stato_messaggi(msg_df, oggi)
+    stato_per_id = dict(zip(msg_df["id"][::-1], stato[::-1]))
+    titolo_per_id = dict(zip(msg_df["id"][::-1], msg_df["titolo"][::-1]))
+    if eliminati is not None:
+        for i, t in zip(eliminati["id"], eliminati["titolo"]):
+            if i not in titolo_per_id:
+                titolo_per_id[i] = t
+                stato_per_id[i] = "ELIMINATO"
+
+    m = log["msg"].astype(str)
+    generico = m.isin(["PRESENZA", "GENERICO"])
+    # id sconosciuti o righe storiche con l'HTML intero: titolo dal valore stesso
+    titoli = {u: titolo_per_id.get(u) or first_line_title(u) for u in m[~generico].unique()}
+
+    # PDV con l'etichetta attuale (indice); il nome registrato se l'id
+    # non c'è più o manca (righe storiche)
+    pdv = log["pdv"].astype(str)
+    if indice is not None:
+        ids = log["pdv_id"].astype(str)
+        etichette = {x: indice.etichetta(x) for x in ids.unique() if x in indice.nome_per_id}
+        pdv = ids.map(etichette).fillna(pdv)
+
+    out = pd.DataFrame({
+        "N°": range(primo, primo + len(log)),
+        "data": formatta_data_log(log["data"]).values,
+        "pdv": pdv.values,
+        "messaggio": m.map(titoli).where(~generico, "GENERICO").values,
+        "stato": m.map(stato_per_id).fillna("").where(~generico, "nm").values,
+    })
+    return out
 
+# schemi ammessi per i link: href ripuliti e pulsanti LINK della pagina dipendenti
+SCHEMI_URL_OK = ("http", "https", "mailto", "tel")
+
+
+def url_ammesso(u: str) -> bool:
+    return urlparse((u or "").strip()).scheme.lower() in SCHEMI_URL_OK
 
-def stato_da_fullmsg(full_msg: str, msg_df: pd.DataFrame) -> str:
-    if full_msg in ("PRESENZA", "GENERICO"):
-        return "nm"
-    if msg_df.empty:
-        return ""
-    m = msg_df[msg_df["msg"] == full_msg]
-    if m.empty:
-        return ""
-    r = m.iloc[0]
-    return stato_msg(r["inizio"], r["fine"])
 
 def extract_urls_from_html(html_msg: str) -> list[str]:
     s = html_msg or ""
     # prende URL sia da href che da testo incollato
     urls = re.findall(r'href=[\'"]([^\'"]+)[\'"]', s, flags=re.IGNORECASE)
-    urls += re.findall(r'(https?://[^\s"<>\]]+)', s, flags=re.IGNORECASE)
+    urls += re.findall(r"(https?://[^\s\"'<>\]]+)", s, flags=re.IGNORECASE)
 
     # pulizia e dedup mantenendo ordine
     out = []
     seen = set()
     for u in urls:
         u = u.strip().rstrip(").,;")
-        if not u:
+        if not u or not url_ammesso(u):
             continue
         if u not in seen:
             seen.add(u)
@@ -232,10 +582,1391 @@ def classify_url(u: str):
 
     return ("🌐 Apri sito", "web")
 
+
+# HTML del messaggio ripulito: solo i tag/attributi prodotti dall'editor
+TAG_OK = {
+    "p", "br", "strong", "b", "em", "i", "u", "s", "a", "ul", "ol", "li",
+    "h1", "h2", "h3", "blockquote", "pre", "code", "span", "sub", "sup",
+}
+TAG_SCARTA = {"script", "style", "iframe", "object", "embed", "template"}
+STILI_OK = {"color", "background-color", "text-align"}
+VALORE_STILE_RE = re.compile(r"^[#a-z0-9(),.%\s-]+$", re.IGNORECASE)
+CLASSE_RE = re.compile(r"^ql-[a-z0-9-]+$")
+
+
+class SanitizzaHtml(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out = []
+        self.scarta = 0
+
+    def _attr(self, tag, k, v):
+        v = v or ""
+        if k == "href" and tag == "a":
+            if url_ammesso(v):
+                return v.strip()
+        elif k == "class":
+            classi = [c for c in v.split() if CLASSE_RE.match(c)]
+            return " ".join(classi) or None
+        elif k == "style":
+            regole = []
+            for decl in v.split(";"):
+                nome, _, valore = decl.partition(":")
+                nome, valore = nome.strip().lower(), valore.strip()
+                if nome in STILI_OK and VALORE_STILE_RE.match(valore):
+                    regole.append(f"{nome}: {valore}")
+            return "; ".join(regole) or None
+        return None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in TAG_SCARTA:
+            self.scarta += 1
+        if self.scarta or tag not in TAG_OK:
+            return
+        parti = [tag]
+        for k, v in attrs:
+            v = self._attr(tag, k, v)
+            if v is not None:
+                parti.append(f'{k}="{html.escape(v)}"')
+        if tag == "a":
+            parti.append('target="_blank" rel="noopener"')
+        self.out.append(f"<{' '.join(parti)}>")
+
+    def handle_endtag(self, tag):
+        if tag in TAG_SCARTA:
+            self.scarta = max(0, self.scarta - 1)
+        elif not self.scarta and tag in TAG_OK and tag != "br":
+            self.out.append(f"</{tag}>")
+
+    def handle_data(self, data):
+        if not self.scarta:
+            self.out.append(html.escape(data, quote=False))
+
+
+def sanitizza_html(html_msg: str) -> str:
+    p = SanitizzaHtml()
+    p.feed(html_msg or "")
+    p.close()
+    return "".join(p.out)
+
+
+def deriva_msg(msg_df: pd.DataFrame) -> pd.DataFrame:
+    # titolo, testo, link classificati e card HTML ripulita: calcolati una
+    # volta per i messaggi nuovi o modificati (hash diverso dal contenuto)
+    df = msg_df.reindex(columns=MSG_COLS + MSG_DERIVATI).fillna("")
+    h = df["msg"].map(hash_msg)
+    da_fare = (df["titolo"] == "") | (df["hash"] != h)
+    if not da_fare.any():
+        return df
+    df = df.copy()
+    html_msg = df.loc[da_fare, "msg"]
+    df.loc[da_fare, "hash"] = h[da_fare]
+    df.loc[da_fare, "titolo"] = html_msg.map(first_line_title)
+    df.loc[da_fare, "testo"] = html_msg.map(strip_html_to_text)
+    df.loc[da_fare, "link"] = html_msg.map(lambda s: json.dumps(
+        [{"url": u, "label": classify_url(u)[0], "tipo": classify_url(u)[1]}
+         for u in extract_urls_from_html(s)],
+        ensure_ascii=False
+    ))
+    df.loc[da_fare, "card"] = html_msg.map(sanitizza_html)
+    return df
+
+# =========================================================
+# 💾 STORAGE (CSV / SQLITE)
+# =========================================================
+TABLE_COLS = {
+    "pdv": PDV_COLS, "msg": MSG_COLS + MSG_DERIVATI, "log": LOG_COLS,
+    "gruppi": GRUPPI_COLS, "eliminati": ELIMINATI_COLS,
+}
+
+# id riga del log = YYYYMM * ID_MESE + posizione nella partizione
+ID_MESE = 10 ** 8
+# snapshot tenuti in memoria oltre a quello di oggi (giorni scelti in REPORT)
+SNAPSHOT_ALTRI_GIORNI = 4
+
+
+class SnapshotGiorno:
+    # messaggi attivi in un giorno, per PDV: la pagina dipendenti legge solo
+    # questo; ricostruito al cambio di giorno o quando cambiano i messaggi
+    def __init__(self, giorno, msg_df, bersagli):
+        self.giorno = giorno
+        self.bersagli = bersagli
+        self.attivi = msg_df[stato_messaggi(msg_df, giorno) == "ATTIVO"]
+        per_pdv = {}
+        for pos, ids in enumerate(self.attivi["pdv_ids"]):
+            for x in bersagli.ids(ids):
+                per_pdv.setdefault(x, []).append(pos)
+        self.per_pdv = per_pdv
+        self.creato = now_str()
+
+    def messaggi(self, pdv_id):
+        return self.attivi.iloc[self.per_pdv.get(pdv_id, [])]
+
+    def stats(self):
+        return {
+            "giorno": self.giorno.strftime("%d-%m-%Y"),
+            "messaggi attivi": len(self.attivi),
+            "pdv con messaggi": len(self.per_pdv),
+            "assegnazioni": sum(map(len, self.per_pdv.values())),
+            "creato": self.creato,
+        }
+
+
+COPERTURA_COLS = [
+    "MESSAGGIO", "inizio", "fine", "PDV target", "visti", "visti nel giorno",
+    "presenti nel giorno", "mancanti", "copertura %",
+]
+
+
+class CoperturaLog:
+    # conferme per messaggio e giorno, tenute in memoria: aggiornate a ogni
+    # append del log, ricalcolate da zero solo se il log cambia per altre vie
+    def __init__(self, log=None):
+        self.visti = {}  # msg_id -> {pdv_id: giorno della prima conferma}
+        self.presenti = {}  # giorno -> {pdv_id con almeno un check-in}
+        self.righe = 0
+        self.creato = now_str()
+        if log is None or log.empty:
+            return
+        # righe senza data valida o senza pdv_id: non attribuite
+        giorno = log["data"].dt.normalize().where(log["pdv_id"] != "")
+        coppie = pd.DataFrame({"giorno": giorno, "pdv_id": log["pdv_id"]}).dropna().drop_duplicates()
+        for g, pdv_id in coppie.groupby("giorno")["pdv_id"]:
+            self.presenti[g.date()] = set(pdv_id)
+        conferme = ~log["msg"].isin(["PRESENZA", "GENERICO"]) & giorno.notna()
+        primi = pd.DataFrame({
+            "msg": log["msg"][conferme],
+            "pdv_id": log["pdv_id"][conferme],
+            "giorno": giorno[conferme],
+        }).sort_values("giorno", kind="stable").drop_duplicates(["msg", "pdv_id"])
+        for msg, pdv_id, g in zip(primi["msg"], primi["pdv_id"], primi["giorno"].dt.date):
+            self.visti.setdefault(msg, {})[pdv_id] = g
+        self.righe = len(log)
+
+    def aggiorna(self, rows):
+        for data, _, msg, pdv_id in rows:
+            g = giorno_log(data)
+            if g is None or not pdv_id:
+                continue
+            self.presenti.setdefault(g, set()).add(pdv_id)
+            if msg not in ("PRESENZA", "GENERICO"):
+                primo = self.visti.setdefault(msg, {})
+                if pdv_id not in primo or g < primo[pdv_id]:
+                    primo[pdv_id] = g
+        self.righe += len(rows)
+
+    def tabella(self, attivi, bersagli, giorno):
+        # una riga per messaggio attivo nel giorno; log e target per id PDV
+        g = giorno
+        presenti = self.presenti.get(g, set())
+        righe = []
+        for r in attivi.itertuples(index=False):
+            ids = bersagli.ids(r.pdv_ids)
+            visti = self.visti.get(r.id, {})
+            giorni = [visti.get(x) for x in ids]
+            n_visti = sum(1 for x in giorni if x is not None and x <= g)
+            righe.append([
+                r.titolo, r.inizio, r.fine, len(ids), n_visti,
+                sum(1 for x in giorni if x == g),
+                sum(1 for x in ids if x in presenti),
+                len(ids) - n_visti,
+                round(100 * n_visti / len(ids), 1) if ids else 0.0,
+            ])
+        return pd.DataFrame(righe, columns=COPERTURA_COLS)
+
+
+def righe_eliminati(msg_df) -> list:
+    ora = now_str()
+    return [[r.id, r.titolo, r.inizio, r.fine, ora] for r in msg_df.itertuples(index=False)]
+
+
+class CsvStorage:
+    files = {
+        "pdv": PDV_FILE, "msg": MSG_FILE, "log": LOG_FILE,
+        "gruppi": GRUPPI_FILE, "eliminati": ELIMINATI_FILE,
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._chiavi = set()
+        self._chiavi_sig = None
+        self._copertura = None
+        self._copertura_sig = None
+        self._lock_indice = threading.Lock()
+        self._snapshot = {}
+        self._indice_pdv = None
+        self._bersagli = None
+        self._lock_log = threading.Lock()
+        self._log = None
+        self._mese_caldo = None
+
+    def load(self, table):
+        if table == "log":
+            return self._log_completo()
+        df = load_csv(self.files[table], TABLE_COLS[table])
+        if list(df.columns) == TABLE_COLS[table]:
+            return df
+        return df.reindex(columns=TABLE_COLS[table], fill_value="")
+
+    def save(self, table, df):
+        if table == "log":
+            return self._salva_log(df)
+        if table == "msg":
+            df = deriva_msg(df)
+        save_csv(df[TABLE_COLS[table]], self.files[table])
+
+    def aggiungi_messaggi(self, nuovi):
+        # una sola riscrittura atomica: o tutti i messaggi o nessuno
+        self.save("msg", pd.concat([self.load("msg"), nuovi], ignore_index=True))
+
+    def elimina_messaggi(self, ids):
+        # prima il registro degli eliminati, poi i messaggi: il log non
+        # resta mai con id senza titolo
+        msg = self.load("msg")
+        via = msg["id"].isin(list(ids))
+        append_csv_rows(ELIMINATI_FILE, righe_eliminati(msg[via]), ELIMINATI_COLS)
+        self.save("msg", msg[~via])
+
+    def append(self, table, row):
+        self.append_many(table, [row])
+
+    def append_many(self, table, rows):
+        if table != "log":
+            return append_csv_rows(self.files[table], rows, TABLE_COLS[table])
+        per_mese = {}
+        for row in rows:
+            per_mese.setdefault(mese_log(row[0]), []).append(row)
+        with self._lock:
+            ultimo = max(per_mese)
+            if ultimo != self._mese_caldo:
+                # primo append del processo o cambio mese: archivia i mesi chiusi
+                self._mese_caldo = ultimo
+                self.compatta_log(ultimo)
+            os.makedirs(LOG_DIR, exist_ok=True)
+            prima = self.firma_log()
+            for mese, righe in sorted(per_mese.items()):
+                append_csv_rows(os.path.join(LOG_DIR, f"{mese}.csv"), righe, LOG_COLS)
+            self._dopo_append(prima, self.firma_log(), rows)
+
+    def _dopo_append(self, prima, dopo, rows):
+        # chiavi di gia_registrato e contatori di copertura già in memoria:
+        # aggiornati senza rileggere il log, se erano allineati prima dell'append
+        if self._chiavi_sig == prima:
+            self._chiavi.update((pdv_id, msg) for _, _, msg, pdv_id in rows)
+            self._chiavi.update(
+                (pdv_id, msg, giorno_log(data)) for data, _, msg, pdv_id in rows if msg == "PRESENZA"
+            )
+            self._chiavi_sig = dopo
+        if self._copertura_sig == prima:
+            self._copertura.aggiorna(rows)
+            self._copertura_sig = dopo
+
+    # ----- log partizionato per mese in LOG_DIR: YYYY-MM.csv per il mese
+    # ----- corrente (append), YYYY-MM.parquet (zstd) per i mesi chiusi
+    def _file_log(self, dal=None, al=None):
+        if not os.path.isdir(LOG_DIR):
+            return []
+        da = dal.strftime("%Y-%m") if dal else None
+        a = al.strftime("%Y-%m") if al else None
+        out = []
+        for nome in os.listdir(LOG_DIR):
+            mese, ext = os.path.splitext(nome)
+            if ext not in (".csv", ".parquet"):
+                continue
+            if (da and mese < da) or (a and mese > a):
+                continue
+            out.append((mese, ext == ".csv", os.path.join(LOG_DIR, nome)))
+        return [(mese, path) for mese, _, path in sorted(out)]
+
+    def firma_log(self):
+        return tuple((path, file_signature(path)) for _, path in self._file_log())
+
+    def _concat_log(self, files):
+        parti, usati = [], {}
+        for mese, path in files:
+            df = load_csv(path, LOG_COLS, tipizza_log)
+            base = int(mese.replace("-", "")) * ID_MESE + usati.get(mese, 0)
+            usati[mese] = usati.get(mese, 0) + len(df)
+            parti.append(df.set_axis(pd.RangeIndex(base, base + len(df)), axis=0))
+        if not parti:
+            return tipizza_log(pd.DataFrame(columns=LOG_COLS))
+        # categorie unite senza passare da colonne di stringhe
+        unisci = pd.api.types.union_categoricals
+        return pd.DataFrame({
+            "data": pd.concat([p["data"] for p in parti]),
+            "pdv": unisci([p["pdv"] for p in parti]),
+            "msg": unisci([p["msg"] for p in parti]),
+            "pdv_id": unisci([p["pdv_id"] for p in parti]),
+        })
+
+    def _log_completo(self):
+        firma = self.firma_log()
+        with self._lock_log:
+            if self._log is None or self._log[0] != firma:
+                self._log = (firma, self._concat_log(self._file_log()))
+            return self._log[1]
+
+    def _scrivi_mese(self, mese, df, corrente):
+        csv_path = os.path.join(LOG_DIR, f"{mese}.csv")
+        pq_path = os.path.join(LOG_DIR, f"{mese}.parquet")
+        df = df[LOG_COLS].reset_index(drop=True)
+        if df.empty:
+            remove_file(csv_path)
+            remove_file(pq_path)
+        elif mese >= corrente:
+            save_csv(testo_log(df), csv_path)
+            remove_file(pq_path)
+        else:
+            # archivio tipizzato: timestamp e dizionari, riletto senza conversioni
+            save_parquet(df.assign(
+                pdv=df["pdv"].cat.remove_unused_categories(),
+                msg=df["msg"].cat.remove_unused_categories(),
+                pdv_id=df["pdv_id"].cat.remove_unused_categories(),
+            ), pq_path)
+            remove_file(csv_path)
+
+    def _salva_log(self, df):
+        os.makedirs(LOG_DIR, exist_ok=True)
+        corrente = mese_log(now_str())
+        scritti = set()
+        if not df.empty:
+            df = tipizza_log(df)
+            for mese, parte in df.groupby(mesi_log(df["data"]), sort=True):
+                self._scrivi_mese(mese, parte, corrente)
+                scritti.add(mese)
+        for mese, path in self._file_log():
+            if mese not in scritti:
+                remove_file(path)
+
+    def compatta_log(self, corrente=None):
+        # i CSV dei mesi chiusi diventano archivi parquet (uniti a un
+        # eventuale archivio già presente per lo stesso mese); il CSV del
+        # mese corrente si riscrive se l'intestazione non è LOG_COLS
+        # (colonna aggiunta): gli append scrivono righe di LOG_COLS
+        corrente = corrente or mese_log(now_str())
+        for mese, path in self._file_log():
+            if path.endswith(".csv") and (mese < corrente or intestazione_csv(path) != LOG_COLS):
+                files = [(m, p) for m, p in self._file_log() if m == mese]
+                self._scrivi_mese(mese, self._concat_log(files), corrente)
+
+    def partiziona_log(self):
+        # log.csv unico (versioni precedenti) -> partizioni mensili
+        if os.path.exists(LOG_FILE):
+            legacy = pd.read_csv(LOG_FILE, dtype=str).fillna("")
+            legacy = tipizza_log(legacy.reindex(columns=LOG_COLS, fill_value=""))
+            parti = [df for df in (self._log_completo(), legacy) if not df.empty]
+            if parti:
+                self._salva_log(pd.concat(parti, ignore_index=True))
+            os.replace(LOG_FILE, LOG_FILE + ".migrato")
+        self.compatta_log()
+
+    def versione(self, table):
+        return file_signature(self.files[table])
+
+    def indice_pdv(self):
+        # indice di ricerca condiviso, ricostruito solo se la lista PDV cambia
+        versione = self.versione("pdv")
+        with self._lock_indice:
+            if self._indice_pdv is None or self._indice_pdv[0] != versione:
+                self._indice_pdv = (versione, IndicePdv(self.load("pdv")))
+            return self._indice_pdv[1]
+
+    def bersagli(self):
+        # destinatari compilati in bitset, ricostruiti se cambiano PDV o gruppi
+        versione = (self.versione("pdv"), self.versione("gruppi"))
+        indice = self.indice_pdv()
+        with self._lock_indice:
+            if self._bersagli is None or self._bersagli[0] != versione:
+                self._bersagli = (versione, Bersagli(indice, self.load("gruppi")))
+            return self._bersagli[1]
+
+    def applica_diff_pdv(self, inserisci, aggiorna, elimina):
+        # CSV: un'unica riscrittura con le sole modifiche del diff
+        pdv = self.load("pdv")
+        pdv = pdv[~pdv["pdv_id"].isin(elimina)]
+        nomi = dict(zip(aggiorna["pdv_id"], aggiorna["pdv_nome"]))
+        pdv = pdv.assign(pdv_nome=pdv["pdv_id"].map(nomi).fillna(pdv["pdv_nome"]))
+        self.save("pdv", pd.concat([pdv, inserisci[PDV_COLS]], ignore_index=True))
+
+    def gia_registrato(self, pdv_id, msg_id, giorno=None):
+        # giorno: solo per "PRESENZA", registrata una volta per PDV e giorno
+        with self._lock:
+            sig = self.firma_log()
+            if sig != self._chiavi_sig:
+                log = self.load("log")
+                coppie = log[["pdv_id", "msg"]].drop_duplicates()
+                self._chiavi = set(zip(coppie["pdv_id"], coppie["msg"]))
+                presenze = log[log["msg"] == "PRESENZA"]
+                self._chiavi.update(zip(presenze["pdv_id"], presenze["msg"], presenze["data"].dt.date))
+                self._chiavi_sig = sig
+            chiave = (pdv_id, msg_id) if giorno is None else (pdv_id, msg_id, giorno)
+            return chiave in self._chiavi
+
+    def copertura(self, ricalcola=False):
+        with self._lock:
+            sig = self.firma_log()
+            if ricalcola or self._copertura is None or sig != self._copertura_sig:
+                self._copertura = CoperturaLog(self.load("log"))
+                self._copertura_sig = sig
+            return self._copertura
+
+    def copertura_giorno(self, giorno, ricalcola=False):
+        snap = self.snapshot(giorno)
+        return self.copertura(ricalcola).tabella(snap.attivi, snap.bersagli, giorno)
+
+    def migra_id_messaggi(self):
+        # messaggi senza id/hash (CSV storici) + log che riporta l'HTML intero
+        msg = self.load("msg").copy()
+        manca = msg["id"] == ""
+        if manca.any():
+            msg.loc[manca, "id"] = [nuovo_id_msg() for _ in range(manca.sum())]
+            msg.loc[manca, "hash"] = msg.loc[manca, "msg"].map(hash_msg)
+        if manca.any() or (msg["titolo"] == "").any():
+            self.save("msg", msg)
+            msg = self.load("msg")
+        per_html = dict(zip(msg["msg"][::-1], msg["id"][::-1]))
+        log = self.load("log")
+        if log["msg"].cat.categories.isin(list(per_html)).any():
+            m = log["msg"].astype(str)
+            self.save("log", log.assign(msg=m.map(per_html).fillna(m)))
+
+    def migra_id_pdv_log(self):
+        # righe scritte prima di pdv_id: id ricavato dal nome/etichetta
+        # registrati, finché corrispondono a un solo PDV dell'archivio
+        log = self.load("log")
+        vuoti = log["pdv_id"] == ""
+        if not vuoti.any():
+            return
+        trovati = log["pdv"][vuoti].astype(str).map(self.indice_pdv().id_per_etichetta).dropna()
+        if trovati.empty:
+            return
+        ids = log["pdv_id"].astype(str)
+        ids[trovati.index] = trovati
+        self.save("log", log.assign(pdv_id=ids))
+
+    def snapshot(self, giorno):
+        # uno per giorno: quello di oggi (pagina dipendenti) resta sempre,
+        # degli altri giorni solo gli ultimi SNAPSHOT_ALTRI_GIORNI usati
+        bersagli = self.bersagli()
+        chiave = (self.versione("msg"), bersagli)
+        with self._lock_indice:
+            voce = self._snapshot.pop(giorno, None)
+            if voce is None or voce[0] != chiave:
+                voce = (chiave, SnapshotGiorno(giorno, self.load("msg"), bersagli))
+            self._snapshot[giorno] = voce
+            oggi = datetime.now().date()
+            altri = [g for g in self._snapshot if g != oggi]
+            for g in altri[:-SNAPSHOT_ALTRI_GIORNI]:
+                del self._snapshot[g]
+            return voce[1]
+
+    def messaggi_pdv(self, pdv_id, giorno):
+        return self.snapshot(giorno).messaggi(pdv_id)
+
+    def query_log(self, dal=None, al=None, pdv=None, msg=None):
+        # solo le partizioni dei mesi nel periodo richiesto
+        log = self._concat_log(self._file_log(dal, al)) if dal or al else self.load("log")
+        mask = pd.Series(True, index=log.index)
+        if dal:
+            mask &= log["data"] >= pd.Timestamp(dal)
+        if al:
+            mask &= log["data"] < pd.Timestamp(al + timedelta(days=1))
+        if pdv:
+            mask &= log["pdv_id"] == pdv
+        if isinstance(msg, str):
+            mask &= log["msg"] == msg
+        elif msg is not None:
+            mask &= log["msg"].isin(list(msg))
+        return log[mask]
+
+    def conta_log(self, dal=None, al=None, pdv=None, msg=None):
+        return len(self.query_log(dal, al, pdv, msg))
+
+    def pagina_log(self, dal=None, al=None, pdv=None, msg=None, offset=0, limit=100):
+        # righe della pagina; l'indice è l'id riga (per l'eliminazione)
+        return self.query_log(dal, al, pdv, msg).iloc[offset:offset + limit]
+
+    def elimina_log(self, righe):
+        # righe: DataFrame con indice = id riga; si riscrivono solo le
+        # partizioni toccate e solo le righe ancora uguali a quelle mostrate
+        corrente = mese_log(now_str())
+        n = 0
+        for num in sorted({int(i) // ID_MESE for i in righe.index}):
+            mese = f"{num // 100:04d}-{num % 100:02d}"
+            log = self._concat_log([(m, p) for m, p in self._file_log() if m == mese])
+            pos = righe.index.intersection(log.index)
+            uguali = (testo_log(log.loc[pos]) == testo_log(righe.loc[pos])).all(axis=1)
+            if uguali.any():
+                self._scrivi_mese(mese, log.drop(index=uguali[uguali].index), corrente)
+                n += int(uguali.sum())
+        return n
+
+    def iter_log(self, dal=None, al=None, pdv=None, msg=None, chunksize=50000):
+        log = self.query_log(dal, al, pdv, msg)
+        for i in range(0, len(log), chunksize):
+            yield log.iloc[i:i + chunksize]
+
+
+class SqliteStorage(CsvStorage):
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS pdv (pdv_id TEXT, pdv_nome TEXT);
+    CREATE INDEX IF NOT EXISTS ix_pdv_id ON pdv(pdv_id);
+
+    CREATE TABLE IF NOT EXISTS msg (
+        rid INTEGER PRIMARY KEY,
+        msg TEXT, inizio TEXT, fine TEXT, pdv_ids TEXT, file TEXT,
+        id TEXT, hash TEXT,
+        d_inizio TEXT, d_fine TEXT,
+        titolo TEXT, testo TEXT, link TEXT, card TEXT
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS ix_msg_id ON msg(id);
+    CREATE INDEX IF NOT EXISTS ix_msg_date ON msg(d_inizio, d_fine);
+
+    CREATE TABLE IF NOT EXISTS gruppi (gruppo TEXT, pdv_ids TEXT);
+
+    CREATE TABLE IF NOT EXISTS eliminati (id TEXT, titolo TEXT, inizio TEXT, fine TEXT, eliminato TEXT);
+
+    CREATE TABLE IF NOT EXISTS log (
+        id INTEGER PRIMARY KEY,
+        data TEXT, ts TEXT, pdv TEXT, msg TEXT, pdv_id TEXT
+    );
+    CREATE INDEX IF NOT EXISTS ix_log_ts ON log(ts);
+    CREATE INDEX IF NOT EXISTS ix_log_msg ON log(msg, ts);
+
+    CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT);
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._connessioni = queue.LifoQueue()
+        with self.connect() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.executescript(self.SCHEMA)
+            # db creati prima dei campi derivati
+            presenti = {r[1] for r in con.execute("PRAGMA table_info(msg)")}
+            for c in MSG_DERIVATI:
+                if c not in presenti:
+                    con.execute(f"ALTER TABLE msg ADD COLUMN {c} TEXT")
+            # db creati prima di pdv_id nel log: colonna, poi il suo indice
+            if "pdv_id" not in {r[1] for r in con.execute("PRAGMA table_info(log)")}:
+                con.execute("ALTER TABLE log ADD COLUMN pdv_id TEXT DEFAULT ''")
+            con.execute("CREATE INDEX IF NOT EXISTS ix_log_pdv_id_msg ON log(pdv_id, msg)")
+            con.execute("DROP INDEX IF EXISTS ix_log_pdv_msg")
+            # destinatari espansi per riga: sostituiti dai bitset in memoria
+            con.execute("DROP TABLE IF EXISTS msg_pdv")
+        self.migra_da_csv()
+
+    @contextmanager
+    def connect(self):
+        # connessioni riusate (pool): una per operazione in corso, mai
+        # condivisa tra due thread nello stesso momento. Chiudere l'ultima
+        # connessione al db WAL costa un checkpoint + fsync: si tengono aperte
+        try:
+            con = self._connessioni.get_nowait()
+        except queue.Empty:
+            con = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            # FULL: in WAL ogni commit fa fsync del file -wal, una conferma
+            # registrata sopravvive anche a un calo di corrente (NORMAL no)
+            con.execute("PRAGMA synchronous=FULL")
+        try:
+            with con:
+                yield con
+        finally:
+            self._connessioni.put(con)
+
+    def migra_da_csv(self):
+        # import una tantum dei CSV esistenti al primo avvio
+        with self.connect() as con:
+            if con.execute("SELECT 1 FROM meta WHERE k='migrato_csv'").fetchone():
+                return
+        csv_storage = CsvStorage()
+        csv_storage.partiziona_log()
+        csv_storage.migra_id_messaggi()
+        csv_storage.migra_id_pdv_log()
+        for table in ("pdv", "msg", "log", "gruppi", "eliminati"):
+            df = csv_storage.load(table)
+            if not df.empty:
+                self.save(table, df)
+        with self.connect() as con:
+            con.execute("INSERT INTO meta VALUES ('migrato_csv', ?)", (now_str(),))
+
+    def load(self, table):
+        cols = ", ".join(TABLE_COLS[table])
+        with self.connect() as con:
+            df = pd.read_sql_query(f"SELECT {cols} FROM {table} ORDER BY rowid", con, dtype=str)
+        df = df.fillna("")
+        return tipizza_log(df) if table == "log" else df
+
+    def save(self, table, df):
+        if table == "msg":
+            df = deriva_msg(df)
+        if table == "log":
+            df = testo_log(df)
+        df = df.reindex(columns=TABLE_COLS[table]).fillna("")
+        with self.connect() as con:
+            con.execute(f"DELETE FROM {table}")
+            if table == "pdv":
+                con.executemany("INSERT INTO pdv VALUES (?, ?)", df.itertuples(index=False))
+                self._nuova_versione(con, "pdv")
+            elif table == "msg":
+                self._inserisci_msg(con, df, 0)
+            elif table == "gruppi":
+                con.executemany("INSERT INTO gruppi VALUES (?, ?)", df.itertuples(index=False))
+                self._nuova_versione(con, "gruppi")
+            elif table == "eliminati":
+                con.executemany("INSERT INTO eliminati VALUES (?, ?, ?, ?, ?)", df.itertuples(index=False))
+            else:
+                self._nuova_versione(con, "log")
+                con.executemany(
+                    "INSERT INTO log (data, ts, pdv, msg, pdv_id) VALUES (?, ?, ?, ?, ?)",
+                    [(r.data, iso_data(r.data), r.pdv, r.msg, r.pdv_id) for r in df.itertuples(index=False)]
+                )
+
+    def _inserisci_msg(self, con, df, base):
+        self._nuova_versione(con, "msg")
+        cols = ", ".join(TABLE_COLS["msg"])
+        segni = ", ".join("?" * len(TABLE_COLS["msg"]))
+        con.executemany(
+            f"INSERT INTO msg (rid, {cols}, d_inizio, d_fine) VALUES (?, {segni}, ?, ?)",
+            [(base + i, *r, iso_data(r.inizio), iso_data(r.fine))
+             for i, r in enumerate(df.itertuples(index=False), start=1)]
+        )
+
+    def aggiungi_messaggi(self, nuovi):
+        # una transazione: o tutti i messaggi o nessuno
+        df = deriva_msg(nuovi).reindex(columns=TABLE_COLS["msg"]).fillna("")
+        with self.connect() as con:
+            base = con.execute("SELECT COALESCE(MAX(rid), 0) FROM msg").fetchone()[0]
+            self._inserisci_msg(con, df, base)
+
+    def elimina_messaggi(self, ids):
+        ids = list(ids)
+        msg = self.load("msg")
+        with self.connect() as con:
+            self._nuova_versione(con, "msg")
+            con.executemany("INSERT INTO eliminati VALUES (?, ?, ?, ?, ?)", righe_eliminati(msg[msg["id"].isin(ids)]))
+            con.executemany("DELETE FROM msg WHERE id = ?", [(x,) for x in ids])
+
+    def append_many(self, table, rows):
+        if table != "log":
+            raise ValueError(f"append non supportato per {table}")
+        with self._lock:
+            with self.connect() as con:
+                # firma prima e dopo nella stessa transazione
+                con.execute("BEGIN IMMEDIATE")
+                prima = self.firma_log(con)
+                con.executemany(
+                    "INSERT INTO log (data, ts, pdv, msg, pdv_id) VALUES (?, ?, ?, ?, ?)",
+                    [(data, iso_data(data), pdv, msg, pdv_id) for data, pdv, msg, pdv_id in rows]
+                )
+                dopo = self.firma_log(con)
+            self._dopo_append(prima, dopo, rows)
+
+    def firma_log(self, con=None):
+        # versione (riscritture, eliminazioni) + ultimo id (append)
+        if con is None:
+            with self.connect() as con:
+                return self.firma_log(con)
+        return con.execute("SELECT (SELECT v FROM meta WHERE k = 'versione_log'), MAX(id) FROM log").fetchone()
+
+    def _where_log(self, dal, al, pdv, msg):
+        cond, params = [], []
+        if dal:
+            cond.append("ts >= ?")
+            params.append(dal.isoformat())
+        if al:
+            cond.append("ts < ?")
+            params.append((al + timedelta(days=1)).isoformat())
+        if pdv:
+            cond.append("pdv_id = ?")
+            params.append(pdv)
+        if isinstance(msg, str):
+            cond.append("msg = ?")
+            params.append(msg)
+        elif msg is not None:
+            msg = list(msg)
+            cond.append(f"msg IN ({', '.join('?' * len(msg))})" if msg else "0")
+            params += msg
+        where = " WHERE " + " AND ".join(cond) if cond else ""
+        return where, params
+
+    def query_log(self, dal=None, al=None, pdv=None, msg=None):
+        where, params = self._where_log(dal, al, pdv, msg)
+        with self.connect() as con:
+            df = pd.read_sql_query(
+                f"SELECT id, data, pdv, msg, pdv_id FROM log{where} ORDER BY id",
+                con, params=params, index_col="id", dtype=str
+            )
+        return tipizza_log(df)
+
+    def conta_log(self, dal=None, al=None, pdv=None, msg=None):
+        where, params = self._where_log(dal, al, pdv, msg)
+        with self.connect() as con:
+            return con.execute(f"SELECT COUNT(*) FROM log{where}", params).fetchone()[0]
+
+    def pagina_log(self, dal=None, al=None, pdv=None, msg=None, offset=0, limit=100):
+        where, params = self._where_log(dal, al, pdv, msg)
+        with self.connect() as con:
+            df = pd.read_sql_query(
+                f"SELECT id, data, pdv, msg, pdv_id FROM log{where} ORDER BY id LIMIT ? OFFSET ?",
+                con, params=params + [limit, offset], index_col="id", dtype=str
+            )
+        return tipizza_log(df)
+
+    def elimina_log(self, righe):
+        with self.connect() as con:
+            self._nuova_versione(con, "log")
+            cur = con.executemany("DELETE FROM log WHERE id = ?", [(int(i),) for i in righe.index])
+            return cur.rowcount
+
+    def iter_log(self, dal=None, al=None, pdv=None, msg=None, chunksize=50000):
+        where, params = self._where_log(dal, al, pdv, msg)
+        sql = f"SELECT data, pdv, msg, pdv_id FROM log{where} ORDER BY id"
+        with self.connect() as con:
+            for chunk in pd.read_sql_query(sql, con, params=params, dtype=str, chunksize=chunksize):
+                yield tipizza_log(chunk)
+
+    def versione(self, table):
+        # cambia a ogni scrittura della tabella (chiave delle cache in memoria)
+        with self.connect() as con:
+            r = con.execute("SELECT v FROM meta WHERE k = ?", (f"versione_{table}",)).fetchone()
+        return r[0] if r else ""
+
+    def _nuova_versione(self, con, table):
+        con.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (f"versione_{table}", uuid.uuid4().hex))
+
+    def applica_diff_pdv(self, inserisci, aggiorna, elimina):
+        with self.connect() as con:
+            self._nuova_versione(con, "pdv")
+            con.executemany("DELETE FROM pdv WHERE pdv_id = ?", [(x,) for x in elimina])
+            con.executemany(
+                "UPDATE pdv SET pdv_nome = ? WHERE pdv_id = ?",
+                zip(aggiorna["pdv_nome"], aggiorna["pdv_id"])
+            )
+            con.executemany("INSERT INTO pdv VALUES (?, ?)", inserisci[PDV_COLS].itertuples(index=False))
+
+    def gia_registrato(self, pdv_id, msg_id, giorno=None):
+        sql, params = "SELECT 1 FROM log WHERE pdv_id = ? AND msg = ?", [pdv_id, msg_id]
+        if giorno:
+            sql += " AND ts >= ? AND ts < ?"
+            params += [giorno.isoformat(), (giorno + timedelta(days=1)).isoformat()]
+        with self.connect() as con:
+            return con.execute(sql + " LIMIT 1", params).fetchone() is not None
+
+
+
+@st.cache_resource
+def get_storage():
+    if STORAGE_BACKEND == "sqlite":
+        storage = SqliteStorage(DB_FILE)
+    else:
+        storage = CsvStorage()
+        storage.partiziona_log()
+    storage.migra_id_messaggi()
+    storage.migra_id_pdv_log()
+    return storage
+
+
+class ScrittoreLog:
+    # un solo thread scrive il log: le righe messe in coda dalle sessioni
+    # vanno su disco a lotti (una scrittura + fsync ogni pochi ms) e ogni
+    # sessione attende la conferma che la sua riga sia stata salvata
+    def __init__(self, storage, attesa=0.005, max_lotto=500):
+        self.storage = storage
+        self.attesa = attesa
+        self.max_lotto = max_lotto
+        self.coda = queue.Queue()
+        self._thread = threading.Thread(target=self._ciclo, name="scrittore-log", daemon=True)
+        # contesto streamlit: il thread usa le risorse condivise (cache,
+        # metriche). Senza spinner (show_spinner=False): nessun elemento
+        # finisce nella pagina della sessione che ha creato il thread
+        add_script_run_ctx(self._thread)
+        self._thread.start()
+        atexit.register(self.chiudi)
+
+    def scrivi(self, row, timeout=30):
+        fatto, esito = threading.Event(), {}
+        self.coda.put((row, fatto, esito))
+        if not fatto.wait(timeout):
+            raise TimeoutError("riga di log non confermata")
+        if "errore" in esito:
+            raise esito["errore"]
+
+    def _ciclo(self):
+        fine = False
+        while not fine:
+            item = self.coda.get()
+            if item is None:
+                break
+            lotto = [item]
+            scadenza = time.monotonic() + self.attesa
+            while len(lotto) < self.max_lotto:
+                resto = scadenza - time.monotonic()
+                try:
+                    item = self.coda.get(timeout=resto) if resto > 0 else self.coda.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    fine = True
+                    break
+                lotto.append(item)
+            self._scrivi(lotto)
+        # chiusura: quanto resta in coda va comunque scritto
+        resto = []
+        while True:
+            try:
+                item = self.coda.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                resto.append(item)
+        if resto:
+            self._scrivi(resto)
+
+    def _scrivi(self, lotto):
+        try:
+            self.storage.append_many("log", [row for row, _, _ in lotto])
+            get_metriche().conta("lotti log")
+            get_metriche().conta("righe log in lotto", len(lotto))
+        except Exception as e:
+            for _, _, esito in lotto:
+                esito["errore"] = e
+        finally:
+            for _, fatto, _ in lotto:
+                fatto.set()
+
+    def chiudi(self, timeout=10):
+        if self._thread.is_alive():
+            self.coda.put(None)
+            self._thread.join(timeout)
+
+
+@st.cache_resource
+def get_scrittore_log():
+    return ScrittoreLog(get_storage())
+
+
+def registra_log(pdv_id, nome, msg):
+    with timed("checkin"):
+        get_scrittore_log().scrivi([now_str(), nome, msg, pdv_id])
+
+
+# =========================================================
+# 📎 ALLEGATI (salvati per contenuto)
+# =========================================================
+# file su disco: UPLOAD_DIR/<sha256><ext>; nella colonna "file" del
+# messaggio il riferimento "<sha256><ext>/<nome originale>"
+# (i riferimenti senza "/" sono file caricati dalle versioni precedenti).
+# Per le immagini anche le varianti <blob>.thumb.jpg e <blob>.screen.jpg
+CAS_RE = re.compile(r"^([0-9a-f]{64}(?:\.[a-z0-9]+)?)(?:\.(?:thumb|screen)\.jpg)?$")
+IMG_EXT = {".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp"}
+VARIANTI_IMG = {"thumb": 320, "screen": 1080}
+
+
+def salva_allegato(uploaded) -> str:
+    nome = os.path.basename(uploaded.name)
+    ext = os.path.splitext(nome)[1].lower()
+    h = hashlib.sha256()
+    uploaded.seek(0)
+    fd, tmp = tempfile.mkstemp(dir=UPLOAD_DIR, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        for blocco in iter(lambda: uploaded.read(1 << 20), b""):
+            h.update(blocco)
+            f.write(blocco)
+    blob = h.hexdigest() + ext
+    path = os.path.join(UPLOAD_DIR, blob)
+    if os.path.exists(path):
+        os.remove(tmp)  # stesso contenuto già presente: nessuna copia
+    else:
+        os.replace(tmp, path)
+        if ext in IMG_EXT:
+            crea_varianti(path)
+    return f"{blob}/{nome}"
+
+
+def crea_varianti(path):
+    # immagine decodificata una volta sola: ridimensionata e ricompressa
+    try:
+        with Image.open(path) as img:
+            img = ImageOps.exif_transpose(img).convert("RGB")
+            for variante, lato in VARIANTI_IMG.items():
+                copia = img.copy()
+                copia.thumbnail((lato, lato))
+                out = f"{path}.{variante}.jpg"
+                tmp = f"{out}.{uuid.uuid4().hex}.tmp"
+                copia.save(tmp, "JPEG", quality=80, optimize=True, progressive=True)
+                os.replace(tmp, out)
+    except (OSError, ValueError):
+        pass  # non decodificabile: si userà l'originale
+
+
+def variante_allegato(ref: str, variante: str) -> str:
+    # la variante più leggera disponibile (creata al volo per i vecchi upload)
+    path = percorso_allegato(ref)
+    out = f"{path}.{variante}.jpg"
+    if not os.path.exists(out) and os.path.exists(path):
+        crea_varianti(path)
+    return out if os.path.exists(out) else path
+
+
+def percorso_allegato(ref: str) -> str:
+    return os.path.join(UPLOAD_DIR, ref.split("/", 1)[0])
+
+
+def nome_allegato(ref: str) -> str:
+    return ref.split("/", 1)[-1]
+
+
+def conta_riferimenti(msg_df) -> dict:
+    # blob -> numero di messaggi che lo usano
+    blob = msg_df["file"][msg_df["file"] != ""].str.split("/", n=1).str[0]
+    return blob.value_counts().to_dict()
+
+
+def gc_allegati(msg_df) -> int:
+    # elimina i blob non più referenziati da alcun messaggio
+    usati = conta_riferimenti(msg_df)
+    n = 0
+    for e in os.scandir(UPLOAD_DIR):
+        m = CAS_RE.match(e.name)
+        if m and m.group(1) not in usati:
+            os.remove(e.path)
+            n += 1
+    return n
+
+
+@st.cache_resource(max_entries=32)
+def allegato_bytes(path, sig):
+    # un'unica copia in memoria per processo, condivisa da tutte le sessioni
+    # (sig nella chiave: un file cambiato su disco viene riletto)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# =========================================================
+# 📤 EXPORT (su richiesta, a blocchi)
+# =========================================================
+EXPORT_CHUNK = 50000
+EXPORT_LOG_COLS = ["data", "pdv", "pdv_id", "msg", "messaggio", "stato"]
+
+
+def filtra_msg(msg_df, bersagli, dal=None, al=None, pdv=None, msg=None):
+    mask = pd.Series(True, index=msg_df.index)
+    if dal or al:
+        di = pd.to_datetime(msg_df["inizio"], format="%d-%m-%Y", errors="coerce")
+        df = pd.to_datetime(msg_df["fine"], format="%d-%m-%Y", errors="coerce")
+        if dal:
+            mask &= df >= pd.Timestamp(dal)
+        if al:
+            mask &= di <= pd.Timestamp(al)
+    if pdv:
+        # pdv: id del PDV, come nel filtro del log
+        mask &= msg_df["pdv_ids"].map(lambda s: bersagli.contiene(s, pdv))
+    if msg:
+        mask &= msg_df["id"] == msg
+    return msg_df[mask]
+
+
+def scrivi_csv(chunks, path, cols):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        f.write(",".join(cols) + "\n")
+        for chunk in chunks:
+            chunk.to_csv(f, index=False, header=False)
+
+
+def scrivi_excel(chunks, path, cols):
+    # workbook write-only: le righe vanno su disco man mano
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(cols)
+    for chunk in chunks:
+        for row in chunk.itertuples(index=False):
+            ws.append(list(row))
+    wb.save(path)
+
+
+def file_export(prefisso, ext) -> str:
+    # nuovo file in EXPORT_DIR; intanto si tolgono quelli più vecchi di
+    # EXPORT_MAX_ORE (sessioni chiuse senza preparare un altro export)
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    limite = time.time() - EXPORT_MAX_ORE * 3600
+    for e in os.scandir(EXPORT_DIR):
+        try:
+            if e.stat(follow_symlinks=False).st_mtime < limite:
+                shutil.rmtree(e.path) if e.is_dir(follow_symlinks=False) else os.remove(e.path)
+        except FileNotFoundError:
+            pass
+    fd, path = tempfile.mkstemp(prefix=prefisso, suffix=ext, dir=EXPORT_DIR)
+    os.close(fd)
+    return path
+
+
+def prepara_export(storage, dati, formato, dal=None, al=None, pdv=None, msg=None):
+    # genera il file filtrato in EXPORT_DIR: (path, nome download)
+    ext = "csv" if formato == "CSV" else "xlsx"
+    msg_df = storage.load("msg")
+    if dati == "LOG":
+        cols = EXPORT_LOG_COLS
+        nome = f"report.{ext}"
+        eliminati = storage.load("eliminati")
+        indice = storage.indice_pdv()
+        chunks = (
+            build_log_report(c, msg_df, eliminati=eliminati, indice=indice).drop(columns="N°")
+            .assign(msg=c["msg"].values, pdv_id=c["pdv_id"].values)[cols]
+            for c in storage.iter_log(dal, al, pdv, msg, chunksize=EXPORT_CHUNK)
+        )
+    else:
+        cols = MSG_COLS
+        nome = f"messaggi.{ext}"
+        sel = filtra_msg(msg_df, storage.bersagli(), dal, al, pdv, msg)[cols]
+        chunks = (sel.iloc[i:i + EXPORT_CHUNK] for i in range(0, len(sel), EXPORT_CHUNK))
+    path = file_export("export_", "." + ext)
+    if formato == "CSV":
+        scrivi_csv(chunks, path, cols)
+    else:
+        scrivi_excel(chunks, path, cols)
+    return path, nome
+
+
+# =========================================================
+# 🏪 PDV: RICERCA E IMPORT (CSV / XLSX)
+# =========================================================
+def normalizza_testo(s: str) -> str:
+    s = unicodedata.normalize("NFKD", s or "")
+    return "".join(c for c in s if not unicodedata.combining(c)).lower()
+
+
+class IndicePdv:
+    # id -> nome e indice per parola (città, insegna, ...) con ricerca per prefisso
+    def __init__(self, pdv_df):
+        self.ids = [str(x).strip() for x in pdv_df["pdv_id"]]
+        self.nome_per_id = dict(zip(self.ids, pdv_df["pdv_nome"]))
+        # posizione densa 0..n-1 di ogni id: il bit del PDV nei bitset
+        self.pos = {x: i for i, x in enumerate(self.nome_per_id)}
+        self.id_per_pos = list(self.nome_per_id)
+        ripetuti = pd.Series(list(self.nome_per_id.values())).value_counts()
+        self.ripetuti = set(ripetuti[ripetuti > 1].index)
+        per_nome = sorted(self.nome_per_id, key=lambda x: normalizza_testo(self.nome_per_id[x]))
+        self.ordine = {x: i for i, x in enumerate(per_nome)}
+        token = {}
+        for pdv_id, nome in self.nome_per_id.items():
+            for t in re.findall(r"\w+", normalizza_testo(nome)) + [pdv_id.lower()]:
+                token.setdefault(t, set()).add(pdv_id)
+        self.token = token
+        self.chiavi = sorted(token)
+        self.id_per_etichetta = {self.etichetta(x): x for x in self.ids}
+
+    def __len__(self):
+        return len(self.nome_per_id)
+
+    def _prefisso(self, p):
+        i = bisect.bisect_left(self.chiavi, p)
+        out = set()
+        while i < len(self.chiavi) and self.chiavi[i].startswith(p):
+            out |= self.token[self.chiavi[i]]
+            i += 1
+        return out
+
+    def cerca(self, testo, limite=50) -> list[str]:
+        # tutte le parole digitate devono essere prefisso di una parola del PDV
+        parole = re.findall(r"\w+", normalizza_testo(testo))
+        if not parole:
+            return []
+        trovati = None
+        for p in sorted(parole, key=len, reverse=True):
+            trovati = self._prefisso(p) if trovati is None else trovati & self._prefisso(p)
+            if not trovati:
+                return []
+        return sorted(trovati, key=self.ordine.get)[:limite]
+
+    def etichetta(self, pdv_id):
+        nome = self.nome_per_id.get(pdv_id, pdv_id)
+        return f"{nome} ({pdv_id})" if nome in self.ripetuti else nome
+
+
+# ----- destinatari di un messaggio (colonna pdv_ids), una voce per riga:
+#   1234        id PDV
+#   1000-1999   id numerici nell'intervallo
+#   @NOME       gruppo di gruppi.csv, altrimenti catena (prima parola
+#               del nome PDV, es. @ESSELUNGA)
+#   *           tutti i PDV
+# in memoria ogni elenco diventa un bitset sulle posizioni dei PDV
+INTERVALLO_RE = re.compile(r"^(\d+)\s*-\s*(\d+)$")
+
+
+def bitset(posizioni, n) -> np.ndarray:
+    b = np.zeros(n, dtype=bool)
+    b[np.asarray(posizioni, dtype=np.int64)] = True
+    return np.packbits(b, bitorder="little")
+
+
+def bit_acceso(bits, i) -> bool:
+    return bool(bits[i >> 3] >> (i & 7) & 1)
+
+
+def nome_gruppo(s: str) -> str:
+    return normalizza_testo(s).strip().lstrip("@").strip().upper()
+
+
+def id_numerico(x: str) -> bool:
+    # solo la forma canonica: "0123" non rientra negli intervalli
+    return x.isdigit() and x == str(int(x))
+
+
+def compatta_target(testo: str, sep="\n") -> str:
+    # stessi destinatari, elenco più corto: voci ripetute tolte e id
+    # numerici consecutivi (almeno 3) scritti come intervallo
+    voci = list(dict.fromkeys(split_ids(testo)))
+    corse = []
+    for v in sorted(int(x) for x in voci if id_numerico(x)):
+        if corse and v == corse[-1][1] + 1:
+            corse[-1][1] = v
+        else:
+            corse.append([v, v])
+    sostituite = {}
+    for a, b in corse:
+        if b - a >= 2:
+            sostituite.update({str(v): "" for v in range(a, b + 1)})
+            sostituite[str(a)] = f"{a}-{b}"
+    out = [sostituite.get(x, x) for x in voci]
+    return sep.join(x for x in out if x)
+
+
+class Bersagli:
+    # elenchi pdv_ids compilati in bitset sulle posizioni di IndicePdv;
+    # una istanza per versione di PDV e gruppi, elenchi compilati in cache
+    def __init__(self, indice, gruppi_df=None):
+        self.indice = indice
+        self.n = len(indice.pos)
+        numerici = sorted((int(x), i) for x, i in indice.pos.items() if id_numerico(x))
+        self._valori = np.array([v for v, _ in numerici], dtype=np.int64)
+        self._posizioni = np.array([i for _, i in numerici], dtype=np.int64)
+        catene = {}
+        for x, i in indice.pos.items():
+            parole = nome_gruppo(indice.nome_per_id[x]).split()
+            if parole:
+                catene.setdefault(parole[0], []).append(i)
+        self.catene = sorted(catene)
+        self.gruppi = {k: bitset(v, self.n) for k, v in catene.items()}
+        self._cache = {}
+        if gruppi_df is not None:
+            # un gruppo può usare catene e gruppi definiti nelle righe precedenti
+            for nome, testo in zip(gruppi_df["gruppo"], gruppi_df["pdv_ids"]):
+                self.gruppi[nome_gruppo(nome)] = self._compila(testo)
+
+    def _compila(self, testo):
+        pos, bits = [], bitset([], self.n)
+        for voce in split_ids(testo):
+            if voce in self.indice.pos:
+                pos.append(self.indice.pos[voce])
+            elif voce == "*":
+                return np.packbits(np.ones(self.n, dtype=bool), bitorder="little")
+            elif voce.startswith("@"):
+                gruppo = self.gruppi.get(nome_gruppo(voce))
+                if gruppo is not None:
+                    bits = bits | gruppo
+            elif m := INTERVALLO_RE.match(voce):
+                lo = np.searchsorted(self._valori, int(m[1]), "left")
+                hi = np.searchsorted(self._valori, int(m[2]), "right")
+                pos.extend(self._posizioni[lo:hi])
+        return bits | bitset(pos, self.n)
+
+    def bits(self, testo):
+        b = self._cache.get(testo)
+        if b is None:
+            b = self._cache[testo] = self._compila(testo)
+        return b
+
+    def posizioni(self, testo):
+        return np.flatnonzero(np.unpackbits(self.bits(testo), count=self.n, bitorder="little"))
+
+    def ids(self, testo):
+        return [self.indice.id_per_pos[i] for i in self.posizioni(testo)]
+
+    def conta(self, testo):
+        return int(np.unpackbits(self.bits(testo), count=self.n, bitorder="little").sum())
+
+    def contiene(self, testo, pdv_id):
+        i = self.indice.pos.get(pdv_id)
+        return i is not None and bit_acceso(self.bits(testo), i)
+
+    def sconosciute(self, testo):
+        # voci che non corrispondono a nessun PDV, gruppo o catena
+        return [
+            v for v in split_ids(testo)
+            if v != "*" and v not in self.indice.pos and not INTERVALLO_RE.match(v)
+            and not (v.startswith("@") and nome_gruppo(v) in self.gruppi)
+        ]
+
+
+def leggi_file_pdv(uploaded) -> pd.DataFrame:
+    # due colonne: pdv_id, pdv_nome (intestazione facoltativa)
+    if uploaded.name.lower().endswith(".xlsx"):
+        df = pd.read_excel(uploaded, header=None, dtype=str, usecols=[0, 1])
+    else:
+        prima = uploaded.readline().decode("utf-8-sig", errors="replace")
+        uploaded.seek(0)
+        sep = ";" if ";" in prima else ","
+        df = pd.read_csv(
+            uploaded, sep=sep, header=None, dtype=str, usecols=[0, 1],
+            encoding="utf-8-sig", skip_blank_lines=True
+        )
+    df.columns = PDV_COLS
+    df = df.fillna("").apply(lambda c: c.str.strip())
+    if not df.empty and df.iloc[0]["pdv_id"].lower() in ("pdv_id", "id"):
+        df = df.iloc[1:]
+    # numero di riga nel file, per i messaggi di errore
+    df.index = df.index + 1
+    return df
+
+
+def valida_pdv(df) -> list[str]:
+    errori = []
+    for campo in PDV_COLS:
+        vuoti = df.index[df[campo] == ""]
+        if len(vuoti):
+            errori.append(f"{campo} mancante alle righe: {', '.join(map(str, vuoti[:20]))}")
+    dup = df[df["pdv_id"].duplicated(keep=False) & (df["pdv_id"] != "")]
+    for pdv_id, righe in dup.groupby("pdv_id").groups.items():
+        errori.append(f"pdv_id {pdv_id} duplicato alle righe: {', '.join(map(str, righe[:20]))}")
+    return errori
+
+
+def diff_pdv(attuale, nuovo, sostituisci=False):
+    # -> (inserimenti, modifiche, id da eliminare)
+    attuale = attuale.drop_duplicates("pdv_id", keep="last")
+    m = nuovo.merge(attuale, on="pdv_id", how="left", suffixes=("", "_old"), indicator=True)
+    inserisci = m.loc[m["_merge"] == "left_only", PDV_COLS]
+    aggiorna = m.loc[(m["_merge"] == "both") & (m["pdv_nome"] != m["pdv_nome_old"]), PDV_COLS]
+    elimina = []
+    if sostituisci:
+        elimina = sorted(set(attuale["pdv_id"]) - set(nuovo["pdv_id"]))
+    return inserisci, aggiorna, elimina
+
+
+# =========================================================
+# 📣 CAMPAGNE: PIÙ MESSAGGI DA UN FILE (CSV / XLSX)
+# =========================================================
+# una riga per messaggio, intestazione obbligatoria:
+#   testo         testo semplice (una riga = un paragrafo) o HTML
+#   inizio, fine  dd-mm-YYYY, dd/mm/YYYY o date Excel
+#   destinatari   come nel messaggio singolo (id, intervalli, @GRUPPO, *)
+#   allegato      facoltativo: nome di un file caricato con la campagna
+#                 o riferimento di un allegato già salvato
+CAMPAGNA_COLS = ["testo", "inizio", "fine", "destinatari", "allegato"]
+CAMPAGNA_ALIAS = {"messaggio": "testo", "msg": "testo", "pdv_ids": "destinatari", "pdv": "destinatari", "file": "allegato"}
+
+
+def leggi_file_campagna(uploaded) -> pd.DataFrame:
+    if uploaded.name.lower().endswith(".xlsx"):
+        df = pd.read_excel(uploaded, dtype=str)
+    else:
+        prima = uploaded.readline().decode("utf-8-sig", errors="replace")
+        uploaded.seek(0)
+        sep = ";" if ";" in prima else ","
+        df = pd.read_csv(uploaded, sep=sep, dtype=str, encoding="utf-8-sig", skip_blank_lines=True)
+    nomi = {c: str(c).strip().lower() for c in df.columns}
+    df = df.rename(columns={c: CAMPAGNA_ALIAS.get(n, n) for c, n in nomi.items()})
+    mancanti = [c for c in CAMPAGNA_COLS[:4] if c not in df.columns]
+    if mancanti:
+        raise ValueError(f"colonne mancanti: {', '.join(mancanti)}")
+    df = df.reindex(columns=CAMPAGNA_COLS).fillna("").apply(lambda c: c.str.strip())
+    df = df[(df != "").any(axis=1)]
+    # numero di riga nel file (riga 1 = intestazione), per i messaggi di errore
+    df.index = df.index + 2
+    return df
+
+
+def leggi_date(col: pd.Series) -> pd.Series:
+    # dd-mm-YYYY, dd/mm/YYYY, YYYY-mm-dd; l'ora (celle Excel) è ignorata
+    giorno = col.str.split(" ").str[0]
+    out = pd.to_datetime(giorno, format="%d-%m-%Y", errors="coerce")
+    for formato in ("%d/%m/%Y", "%Y-%m-%d"):
+        out = out.fillna(pd.to_datetime(giorno, format=formato, errors="coerce"))
+    return out
+
+
+def allegato_salvato(ref: str) -> bool:
+    blob = ref.split("/", 1)[0]
+    return bool(CAS_RE.match(blob)) and os.path.isfile(percorso_allegato(ref))
+
+
+def valida_campagna(df, bersagli, caricati=()) -> pd.DataFrame:
+    # errori riga per riga (riga, errore); vuoto = campagna applicabile
+    if df.empty:
+        return pd.DataFrame([[0, "nessun messaggio nel file"]], columns=["riga", "errore"])
+    inizio, fine = leggi_date(df["inizio"]), leggi_date(df["fine"])
+    n_pdv = df["destinatari"].map(bersagli.conta)
+    sconosciute = df["destinatari"].map(bersagli.sconosciute)
+    allegato_ok = df["allegato"].map(lambda a: a == "" or a in caricati or allegato_salvato(a))
+    controlli = [
+        (df["testo"] == "", "testo mancante"),
+        (inizio.isna(), "data inizio non valida"),
+        (fine.isna(), "data fine non valida"),
+        (fine < inizio, "data fine prima della data inizio"),
+        (df["destinatari"] == "", "destinatari mancanti"),
+        ((df["destinatari"] != "") & (n_pdv == 0), "nessun PDV tra i destinatari"),
+        (df.duplicated(["testo", "inizio", "fine", "destinatari"]), "riga ripetuta"),
+    ]
+    errori = [(r, testo) for mask, testo in controlli for r in df.index[mask]]
+    errori += [
+        (r, "destinatari non riconosciuti: " + ", ".join(v[:10]))
+        for r, v in sconosciute.items() if v
+    ]
+    errori += [(r, f"allegato non trovato: {a}") for r, a in df["allegato"][~allegato_ok].items()]
+    return pd.DataFrame(sorted(errori), columns=["riga", "errore"])
+
+
+def testo_html(testo: str) -> str:
+    # l'HTML (es. copiato dall'editor) resta com'è
+    if re.search(r"<[a-zA-Z/][^>]*>", testo):
+        return testo
+    return "".join(f"<p>{html.escape(r)}</p>" for r in testo.splitlines() if r.strip())
+
+
+def prepara_campagna(df, caricati=None) -> pd.DataFrame:
+    # righe già validate -> messaggi; ogni allegato caricato salvato una volta
+    caricati = caricati or {}
+    refs = {a: salva_allegato(caricati[a]) for a in set(df["allegato"]) if a in caricati}
+    msg = df["testo"].map(testo_html)
+    return pd.DataFrame({
+        "msg": msg,
+        "inizio": leggi_date(df["inizio"]).dt.strftime("%d-%m-%Y"),
+        "fine": leggi_date(df["fine"]).dt.strftime("%d-%m-%Y"),
+        "pdv_ids": df["destinatari"].map(compatta_target),
+        "file": df["allegato"].map(lambda a: refs.get(a, a)),
+        "id": [nuovo_id_msg() for _ in range(len(df))],
+        "hash": msg.map(hash_msg),
+    }, columns=MSG_COLS).reset_index(drop=True)
+
+
 # =========================================================
 # 🖼️ RENDER MESSAGGIO → IMMAGINE
 # =========================================================
-def render_msg_image(html_msg: str, logo_path="logo.png"):
+@functools.lru_cache(maxsize=8)
+def get_render_assets(logo_path="logo.png", logo_sig=None):
+    # font e logo ridimensionato caricati una volta per processo
+    # (logo_sig nella chiave: un logo nuovo su disco invalida la cache).
+    # Cache semplice, niente API streamlit: la usano anche i processi del
+    # pool di zip_immagini_pdv
+    try:
+        fonts = (
+            ImageFont.truetype("DejaVuSans-Bold.ttf", 34),
+            ImageFont.truetype("DejaVuSans.ttf", 26),
+            ImageFont.truetype("DejaVuSans.ttf", 20),
+        )
+    except:
+        fonts = (ImageFont.load_default(),) * 3
+
+    logo = None
+    if logo_sig is not None:
+        logo = Image.open(logo_path).convert("RGBA")
+        logo.thumbnail((220, 80))
+    return fonts, logo
+
+
+def render_msg_image(html_msg: str, logo_path="logo.png", giorno=None):
 
     text = strip_html_to_text(html_msg)
 
@@ -246,13 +1977,9 @@ def render_msg_image(html_msg: str, logo_path="logo.png"):
     border_color = "#C00000"
     text_color = "black"
 
-    # --- FONT ---
-    try:
-        font_title = ImageFont.truetype("DejaVuSans-Bold.ttf", 34)
-        font_text = ImageFont.truetype("DejaVuSans.ttf", 26)
-        font_date = ImageFont.truetype("DejaVuSans.ttf", 20)
-    except:
-        font_title = font_text = font_date = ImageFont.load_default()
+    # --- FONT E LOGO (cache di processo) ---
+    fonts, logo = get_render_assets(logo_path, file_signature(logo_path))
+    font_title, font_text, font_date = fonts
 
     # --- TITOLO AUTOMATICO ---
     title = first_line_title(html_msg)
@@ -280,13 +2007,11 @@ def render_msg_image(html_msg: str, logo_path="logo.png"):
     )
 
     # --- LOGO ---
-    if os.path.exists(logo_path):
-        logo = Image.open(logo_path).convert("RGBA")
-        logo.thumbnail((220, 80))
+    if logo is not None:
         img.paste(logo, (padding, 20), logo)
 
     # --- DATA ---
-    data_txt = datetime.now().strftime("%d/%m/%Y")
+    data_txt = (giorno or datetime.now().date()).strftime("%d/%m/%Y")
     draw.text(
         (width - 160, 35),
         data_txt,
@@ -311,11 +2036,159 @@ def render_msg_image(html_msg: str, logo_path="logo.png"):
     return img
 
 
+def percorso_img_msg(html_msg: str, giorno, logo_path="logo.png"):
+    chiave = hash_msg(html_msg + repr(file_signature(logo_path)))
+    return os.path.join(IMG_CACHE_DIR, f"{chiave}_{giorno:%Y%m%d}.png")
+
+
+def msg_image_png(html_msg: str, giorno=None, logo_path="logo.png"):
+    # PNG su disco per (hash contenuto + logo, data): mostrare o scaricare
+    # l'immagine è una lettura di file, non un render Pillow
+    giorno = giorno or datetime.now().date()
+    path = percorso_img_msg(html_msg, giorno, logo_path)
+    if os.path.exists(path):
+        os.utime(path)  # mtime = ultimo uso, per l'eviction
+        return path
+    return scrivi_png(html_msg, giorno, logo_path)
+
+
+def scrivi_png(html_msg, giorno, logo_path="logo.png", copia=None, pota=True):
+    # render nella cache; copia: hard link creato prima della potatura.
+    # pota=False nei processi dello ZIP: il padre pota una volta alla fine
+    path = percorso_img_msg(html_msg, giorno, logo_path)
+    os.makedirs(IMG_CACHE_DIR, exist_ok=True)
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    render_msg_image(html_msg, logo_path, giorno).save(tmp, "PNG", optimize=True)
+    if copia:
+        os.link(tmp, copia)
+    os.replace(tmp, path)
+    if pota:
+        pota_cache_img()
+    return path
+
+
+def collega_png(html_msg, giorno, dest, logo_path="logo.png") -> bool:
+    # hard link in dest del PNG già in cache (False se non c'è): dest resta
+    # leggibile anche se nel frattempo la cache viene potata
+    try:
+        os.link(percorso_img_msg(html_msg, giorno, logo_path), dest)
+    except FileNotFoundError:
+        return False
+    os.utime(dest)  # stesso file della cache: conta come uso
+    return True
+
+
+def png_fissato(html_msg, giorno, dest, logo_path="logo.png", pota=True):
+    if not collega_png(html_msg, giorno, dest, logo_path):
+        scrivi_png(html_msg, giorno, logo_path, copia=dest, pota=pota)
+    return dest
+
+
+def pota_cache_img(max_bytes=None):
+    # oltre il limite si eliminano le immagini usate meno di recente
+    max_bytes = IMG_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    files = []
+    for e in os.scandir(IMG_CACHE_DIR):
+        if e.name.endswith(".png"):
+            try:
+                info = e.stat()
+            except FileNotFoundError:
+                continue  # rimosso da un altro processo
+            files.append((info.st_mtime, info.st_size, e.path))
+    totale = sum(f[1] for f in files)
+    for _, size, path in sorted(files):
+        if totale <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        totale -= size
+
+
+# ----- ZIP del giorno: una cartella per PDV con i suoi messaggi in PNG
+def nome_file(s: str) -> str:
+    return re.sub(r'[\\/:*?"<>|\s]+', " ", s or "").strip()[:60]
+
+
+def _png_in_processo(args):
+    # eseguita nei processi del pool: render nella cache + link in dest
+    html_msg, giorno, dest = args
+    return png_fissato(html_msg, giorno, dest, pota=False)
+
+
+def zip_immagini_pdv(snap, path, avanza=None, processi=None):
+    # assegnazioni dallo snapshot del giorno; ogni messaggio distinto è
+    # disegnato una volta sola (in parallelo, un processo per core) e lo
+    # stesso PNG va nelle cartelle di tutti i PDV che lo ricevono.
+    # I PNG del lotto sono fissati con hard link in una cartella propria:
+    # la potatura della cache (IMG_CACHE_MAX_MB) non li toglie prima dello ZIP
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    fissati = tempfile.mkdtemp(prefix="png_", dir=EXPORT_DIR)
+    try:
+        return _zip_immagini_pdv(snap, path, fissati, avanza, processi)
+    finally:
+        shutil.rmtree(fissati, ignore_errors=True)
+
+
+def _zip_immagini_pdv(snap, path, fissati, avanza, processi):
+    avanza = avanza or (lambda fatto, totale, testo: None)
+    html_per_pos = list(snap.attivi["msg"])
+    titoli = list(snap.attivi["titolo"])
+    distinti = list(dict.fromkeys(html_per_pos))
+    png = {h: os.path.join(fissati, f"{i}.png") for i, h in enumerate(distinti)}
+    da_fare = [h for h in distinti if not collega_png(h, snap.giorno, png[h])]
+    totale = len(da_fare) + len(snap.per_pdv)
+
+    if da_fare:
+        # fork: i processi ereditano lo script già caricato. Font e logo si
+        # caricano qui, prima del fork; nei figli solo Pillow e file, nessuna
+        # API streamlit (lock e code del server restano nel processo padre)
+        get_render_assets("logo.png", file_signature("logo.png"))
+        ctx = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(processi or os.cpu_count(), mp_context=ctx) as pool:
+            futuri = [pool.submit(_png_in_processo, (h, snap.giorno, png[h])) for h in da_fare]
+            for i, f in enumerate(as_completed(futuri), 1):
+                f.result()
+                avanza(i, totale, f"Immagini: {i} di {len(da_fare)}")
+        # una sola scansione della cache per tutto il lotto (i PNG del lotto
+        # sono già fissati in `fissati`)
+        pota_cache_img()
+
+    indice = snap.bersagli.indice
+    pdv = sorted(snap.per_pdv, key=lambda x: indice.ordine.get(x, 0))
+    # PNG già compressi: nello ZIP senza ricompressione, letti dal disco a blocchi
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as zf:
+        for k, pdv_id in enumerate(pdv, 1):
+            cartella = nome_file(f"{pdv_id} {indice.nome_per_id.get(pdv_id, '')}")
+            for n, pos in enumerate(snap.per_pdv[pdv_id], 1):
+                zf.write(png[html_per_pos[pos]], f"{cartella}/{n:02d} {nome_file(titoli[pos])}.png")
+            if k % 50 == 0 or k == len(pdv):
+                avanza(len(da_fare) + k, totale, f"PDV: {k} di {len(pdv)}")
+    return len(pdv), len(distinti)
+
+
 # =========================================================
 # ADMIN
 # =========================================================
+def paginazione(totale, key):
+    # selettori "righe per pagina" / "pagina" -> (offset, limit)
+    c1, c2, c3 = st.columns([1, 1, 2])
+    with c1:
+        size = st.selectbox("Righe per pagina", [50, 100, 250, 500], index=1, key=f"{key}_size")
+    pagine = max(1, -(-totale // size))
+    if st.session_state.get(f"{key}_page", 1) > pagine:
+        st.session_state[f"{key}_page"] = pagine
+    with c2:
+        page = st.number_input("Pagina", min_value=1, max_value=pagine, step=1, key=f"{key}_page")
+    with c3:
+        st.caption(f"{totale} righe — pagina {page} di {pagine}")
+    return (page - 1) * size, size
+
+
 def admin():
     st.markdown(CSS_ADMIN, unsafe_allow_html=True)
+    storage = get_storage()
 
     if os.path.exists("logo.png"):
         c1, c2, c3 = st.columns([1, 2, 1])
@@ -332,33 +2205,72 @@ def admin():
         st.rerun()
 
     # ===== DIVISIONE PAGINE ADMIN =====
-    tab_operativo, tab_report = st.tabs(["OPERATIVO", "REPORT"])
+    tab_operativo, tab_report, tab_diagnostica = st.tabs(["OPERATIVO", "REPORT", "DIAGNOSTICA"])
 
     # ================= OPERATIVO =================
     with tab_operativo:
 
         st.header("IMPORTA LISTA PDV")
 
-        pdv_existing = load_csv(PDV_FILE, ["pdv_id", "pdv_nome"])
-        prefill = "\n".join([f"{r['pdv_id']};{r['pdv_nome']}" for _, r in pdv_existing.iterrows()])
-        pdv_text = st.text_area("", value=prefill, height=140)
+        pdv_existing = storage.load("pdv")
 
-        c1, c2 = st.columns(2)
+        file_pdv = st.file_uploader(
+            "File PDV (CSV o XLSX, colonne: pdv_id;pdv_nome)",
+            type=["csv", "txt", "xlsx"],
+            key="pdv_file"
+        )
+        sostituisci = st.checkbox("Elimina i PDV non presenti nel file", key="pdv_sostituisci")
 
-        with c1:
-            if st.button("SALVA LISTA PDV"):
-                rows = []
-                for line in pdv_text.splitlines():
-                    if ";" in line:
-                        a, b = line.split(";", 1)
-                        rows.append([a.strip(), b.strip()])
-                save_csv(pd.DataFrame(rows, columns=["pdv_id", "pdv_nome"]), PDV_FILE)
-                st.success("Lista PDV salvata")
+        if file_pdv:
+            try:
+                nuovo = leggi_file_pdv(file_pdv)
+                errori = valida_pdv(nuovo)
+            except (ValueError, KeyError) as e:
+                nuovo, errori = None, [f"File non leggibile: {e}"]
+
+            if errori:
+                st.error("Import non applicato:\n\n" + "\n\n".join(errori))
+            else:
+                inserisci, aggiorna, elimina = diff_pdv(pdv_existing, nuovo, sostituisci)
+                st.caption(
+                    f"{len(nuovo)} PDV nel file — nuovi: {len(inserisci)}, "
+                    f"modificati: {len(aggiorna)}, da eliminare: {len(elimina)}"
+                )
+                if st.button("APPLICA IMPORT PDV"):
+                    storage.applica_diff_pdv(inserisci, aggiorna, elimina)
+                    st.success("Lista PDV aggiornata")
+                    st.rerun()
 
-        with c2:
-            if st.button("PULISCI LISTA PDV"):
-                save_csv(pd.DataFrame(columns=["ID", "PDV"]), PDV_FILE)
-                st.success("Lista PDV pulita")
+        offset, limit = paginazione(len(pdv_existing), "pdv")
+        st.dataframe(pdv_existing.iloc[offset:offset + limit], hide_index=True)
+
+        if st.button("PULISCI LISTA PDV"):
+            storage.save("pdv", pd.DataFrame(columns=PDV_COLS))
+            st.success("Lista PDV pulita")
+
+        st.markdown("---")
+
+        st.header("GRUPPI PDV")
+        bersagli = storage.bersagli()
+        st.caption(
+            "Un gruppo per riga: nome e destinatari separati da virgola (id, intervalli "
+            "1000-1999, @CATENA, altri gruppi). Nei messaggi si usa @NOME. "
+            f"Catene dai nomi PDV: {', '.join(bersagli.catene[:30]) or '-'}"
+        )
+        gruppi_df = storage.load("gruppi")
+        gruppi_edit = st.data_editor(
+            gruppi_df.assign(pdv_ids=gruppi_df["pdv_ids"].map(lambda x: compatta_target(x, ", "))),
+            num_rows="dynamic", hide_index=True, key="gruppi_edit"
+        )
+        if st.button("SALVA GRUPPI"):
+            gruppi_edit = gruppi_edit.fillna("")
+            gruppi_edit = gruppi_edit[gruppi_edit["gruppo"].map(nome_gruppo) != ""]
+            storage.save("gruppi", gruppi_edit.assign(
+                gruppo=gruppi_edit["gruppo"].map(nome_gruppo),
+                pdv_ids=gruppi_edit["pdv_ids"].map(compatta_target)
+            ))
+            st.success("Gruppi salvati")
+            st.rerun()
 
         st.markdown("---")
 
@@ -389,27 +2301,81 @@ def admin():
         with c2:
             data_fine = st.date_input("DATA FINE")
 
-        pdv_ids = st.text_area("ID PDV (uno per riga)", height=140)
+        pdv_ids = st.text_area(
+            "DESTINATARI (uno per riga: id PDV, intervallo 1000-1999, @CATENA o @GRUPPO, * = tutti)",
+            height=140
+        )
+        if pdv_ids.strip():
+            st.caption(f"{bersagli.conta(pdv_ids)} PDV destinatari")
 
         if st.button("SALVA MESSAGGIO"):
-            df = load_csv(MSG_FILE, ["msg", "inizio", "fine", "pdv_ids", "file"])
-
             filename = ""
             if uploaded:
-                filename = uploaded.name
-                with open(os.path.join(UPLOAD_DIR, filename), "wb") as f:
-                    f.write(uploaded.getbuffer())
+                filename = salva_allegato(uploaded)
 
             new = pd.DataFrame([[
                 msg,
                 data_inizio.strftime("%d-%m-%Y"),
                 data_fine.strftime("%d-%m-%Y"),
-                normalize_lines(pdv_ids),
-                filename
-            ]], columns=df.columns)
+                compatta_target(normalize_lines(pdv_ids)),
+                filename,
+                nuovo_id_msg(),
+                hash_msg(msg)
+            ]], columns=MSG_COLS)
 
-            save_csv(pd.concat([df, new], ignore_index=True), MSG_FILE)
+            storage.aggiungi_messaggi(new)
             st.success("Messaggio salvato")
+            sconosciute = bersagli.sconosciute(pdv_ids)
+            if sconosciute:
+                st.warning("Destinatari non riconosciuti: " + ", ".join(sconosciute[:20]))
+
+        st.markdown("---")
+
+        st.header("IMPORT CAMPAGNA")
+        st.caption(
+            "Un messaggio per riga, con intestazione: testo, inizio, fine, destinatari, "
+            "allegato (facoltativo: nome di un file caricato qui sotto). "
+            "Il file viene applicato solo se tutte le righe sono valide."
+        )
+        esito = st.session_state.pop("camp_esito", None)
+        if esito:
+            st.success(esito)
+        # chiavi nuove dopo ogni import: gli uploader ripartono vuoti
+        n_camp = st.session_state.get("camp_n", 0)
+        file_camp = st.file_uploader("FILE CAMPAGNA (CSV o XLSX)", type=["csv", "xlsx"], key=f"camp_file_{n_camp}")
+        allegati_camp = st.file_uploader(
+            "ALLEGATI DELLA CAMPAGNA",
+            type=["png", "jpg", "jpeg", "pdf"],
+            accept_multiple_files=True,
+            key=f"camp_allegati_{n_camp}"
+        ) or []
+        applicati = st.session_state.setdefault("camp_applicati", set())
+
+        if file_camp and file_camp.file_id in applicati:
+            st.info("Campagna già importata da questo file")
+        elif file_camp:
+            caricati = {os.path.basename(f.name): f for f in allegati_camp}
+            try:
+                camp = leggi_file_campagna(file_camp)
+                errori = valida_campagna(camp, bersagli, caricati)
+            except (ValueError, KeyError) as e:
+                camp, errori = None, pd.DataFrame([[0, f"File non leggibile: {e}"]], columns=["riga", "errore"])
+
+            if not errori.empty:
+                st.error(f"Import non applicato: {len(errori)} errori in {errori['riga'].nunique()} righe")
+                st.dataframe(errori, hide_index=True)
+            else:
+                st.caption(
+                    f"{len(camp)} messaggi pronti, "
+                    f"{camp['destinatari'].map(bersagli.conta).sum()} assegnazioni PDV"
+                )
+                if st.button("APPLICA IMPORT CAMPAGNA"):
+                    storage.aggiungi_messaggi(prepara_campagna(camp, caricati))
+                    # un secondo click (o un doppio click) non reimporta
+                    applicati.add(file_camp.file_id)
+                    st.session_state["camp_n"] = n_camp + 1
+                    st.session_state["camp_esito"] = f"{len(camp)} messaggi salvati"
+                    st.rerun()
         if st.button("LOGOUT", key="logout_operativo"):
             st.session_state["admin_ok"] = False
             st.rerun()
@@ -419,16 +2385,44 @@ def admin():
 
         st.header("STORICO MESSAGGI")
 
-        msg_df = load_csv(MSG_FILE, ["msg", "inizio", "fine", "pdv_ids", "file"])
-
-        view = msg_df.copy()
-        if not view.empty:
-            view.insert(0, "N°", range(1, len(view) + 1))
-            view["MESSAGGIO"] = view["msg"].apply(first_line_title)
-            view["STATO"] = view.apply(lambda r: stato_msg(r["inizio"], r["fine"]), axis=1)
-            view = view[["N°", "MESSAGGIO", "inizio", "fine", "STATO"]]
+        msg_df = storage.load("msg")
+        # PDV per etichetta (il nome, con l'id se il nome è ripetuto);
+        # i filtri usano l'id corrispondente
+        indice = storage.indice_pdv()
+        etichette_pdv = [indice.etichetta(x) for x in sorted(indice.ordine, key=indice.ordine.get)]
+        titoli_msg = msg_df["titolo"]
+        stati_msg = stato_messaggi(msg_df)
+        titoli = dict(zip(msg_df["id"], titoli_msg))
+        titoli["PRESENZA"] = "GENERICO (presenza)"
+        eliminati = storage.load("eliminati")
+        for i, t in zip(eliminati["id"], eliminati["titolo"]):
+            titoli.setdefault(i, f"{t} (eliminato)")
 
-        st.dataframe(msg_df)
+        c1, c2, c3 = st.columns(3)
+        with c1:
+            fm_testo = st.text_input("Cerca nel titolo", key="msg_testo")
+        with c2:
+            fm_stato = st.selectbox("STATO", ["ATTIVO", "CHIUSO"], index=None, placeholder="Tutti", key="msg_stato")
+        with c3:
+            fm_pdv = st.selectbox("PDV", etichette_pdv, index=None, placeholder="Tutti", key="msg_pdv")
+
+        bersagli = storage.bersagli()
+        sel = filtra_msg(msg_df, bersagli, pdv=indice.id_per_etichetta.get(fm_pdv))
+        if fm_stato:
+            sel = sel[stati_msg[sel.index] == fm_stato]
+        if fm_testo:
+            sel = sel[titoli_msg[sel.index].str.contains(fm_testo, case=False, regex=False)]
+
+        offset, limit = paginazione(len(sel), "msg")
+        pagina = sel.iloc[offset:offset + limit]
+        st.dataframe(pd.DataFrame({
+            "N°": pagina.index + 1,
+            "MESSAGGIO": titoli_msg[pagina.index].values,
+            "inizio": pagina["inizio"].values,
+            "fine": pagina["fine"].values,
+            "STATO": stati_msg[pagina.index].values,
+            "N° PDV": pagina["pdv_ids"].map(bersagli.conta).values,
+        }), hide_index=True)
 
         if not msg_df.empty:
             idx_open = st.number_input("Apri messaggio (N°)", min_value=0, max_value=len(msg_df), value=0, step=1)
@@ -451,72 +2445,221 @@ def admin():
         ]
     )
 
-        if not msg_df.empty:
+                img_path = msg_image_png(r["msg"])
+                st.image(img_path, width=450)
+                if r["file"] and os.path.splitext(r["file"])[1].lower() in IMG_EXT:
+                    st.image(variante_allegato(r["file"], "thumb"))
+                with open(img_path, "rb") as f:
+                    st.download_button(
+                        "SCARICA IMMAGINE",
+                        data=f.read(),
+                        file_name=f"messaggio_{idx_open}.png",
+                        mime="image/png"
+                    )
+
+        if not pagina.empty:
             del_idx = st.multiselect(
-                "Rimuovi manualmente messaggi (seleziona N°)",
-                options=list(range(1, len(msg_df) + 1))
+                "Rimuovi manualmente messaggi della pagina (seleziona N°)",
+                options=list(pagina.index + 1),
+                key=f"del_msg_{offset}_{len(msg_df)}"
             )
             if st.button("ELIMINA RIGHE MESSAGGI SELEZIONATE"):
                 if del_idx:
-                    keep = msg_df.drop(index=[i - 1 for i in del_idx]).reset_index(drop=True)
-                    save_csv(keep, MSG_FILE)
+                    storage.elimina_messaggi(msg_df["id"].iloc[[i - 1 for i in del_idx]])
+                    gc_allegati(storage.load("msg"))
                     st.success("Righe messaggi eliminate")
                     st.rerun()
 
         c1, c2, c3 = st.columns(3)
-        with c1:
-            st.download_button("SCARICA CSV", msg_df.to_csv(index=False), "messaggi.csv")
-        with c2:
-            st.download_button("SCARICA EXCEL", excel_bytes(msg_df), "messaggi.xlsx")
         with c3:
             if st.button("PULISCI MESSAGGI"):
-                save_csv(msg_df.iloc[0:0], MSG_FILE)
+                storage.elimina_messaggi(msg_df["id"])
+                gc_allegati(storage.load("msg"))
                 st.success("Messaggi puliti")
                 st.rerun()
 
         st.markdown("---")
 
-        st.header("REPORT LOG")
+        st.header("COPERTURA MESSAGGI")
+        c1, c2 = st.columns([2, 1])
+        with c1:
+            cop_giorno = st.date_input("GIORNO", format="DD/MM/YYYY", key="cop_giorno")
+        with c2:
+            ricalcola = st.button("RICALCOLA DA ZERO")
+        with timed("copertura"):
+            copertura = storage.copertura_giorno(cop_giorno, ricalcola)
+        cont = storage.copertura()
+        st.caption(
+            f"Messaggi attivi nel giorno. Visti = PDV target che hanno confermato il messaggio "
+            f"(entro il giorno); presenti = PDV target con almeno un check-in nel giorno. "
+            f"Contatori su {cont.righe} righe di log, ricalcolati il {cont.creato} "
+            f"e aggiornati a ogni check-in."
+        )
+        st.dataframe(copertura, hide_index=True)
+
+        st.markdown("---")
 
-        log = load_csv(LOG_FILE, ["data", "pdv", "msg"])
+        st.header("REPORT LOG")
 
-        log_view = log.copy()
-        if not log_view.empty:
-            log_view.insert(0, "N°", range(1, len(log_view) + 1))
-            log_view["messaggio"] = log_view["msg"].apply(
-                lambda m: "GENERICO" if m in ("PRESENZA", "GENERICO") else first_line_title(m)
+        c1, c2, c3 = st.columns(3)
+        with c1:
+            fl_dal = st.date_input("DAL", value=None, format="DD/MM/YYYY", key="log_dal")
+            fl_al = st.date_input("AL", value=None, format="DD/MM/YYYY", key="log_al")
+        with c2:
+            fl_pdv = st.selectbox("PDV", etichette_pdv, index=None, placeholder="Tutti", key="log_pdv")
+            fl_msg = st.selectbox(
+                "MESSAGGIO", list(titoli), index=None, placeholder="Tutti",
+                format_func=lambda x: titoli.get(x, x), key="log_msg"
+            )
+        with c3:
+            fl_stato = st.selectbox(
+                "STATO", ["ATTIVO", "CHIUSO", "ELIMINATO", "nm"], index=None, placeholder="Tutti", key="log_stato"
             )
-            log_view["stato"] = log_view["msg"].apply(lambda m: stato_da_fullmsg(m, msg_df))
-            log_view = log_view[["N°", "data", "pdv", "messaggio", "stato"]]
-
-        st.dataframe(log_view)
 
-        if not log.empty:
-            del_log_idx = st.multiselect(
-                "Rimuovi manualmente righe LOG (seleziona N°)",
-                options=list(range(1, len(log) + 1))
+        # lo stato dipende dal messaggio: diventa un filtro sugli id
+        filtro_msg = fl_msg
+        if fl_stato:
+            if fl_stato == "nm":
+                ids = {"PRESENZA", "GENERICO"}
+            elif fl_stato == "ELIMINATO":
+                ids = set(eliminati["id"]) - set(msg_df["id"])
+            else:
+                ids = set(msg_df.loc[stati_msg == fl_stato, "id"])
+            filtro_msg = ids & {fl_msg} if fl_msg else ids
+        filtri = dict(dal=fl_dal, al=fl_al, pdv=indice.id_per_etichetta.get(fl_pdv), msg=filtro_msg)
+
+        totale = storage.conta_log(**filtri)
+        offset, limit = paginazione(totale, "log")
+        righe = storage.pagina_log(**filtri, offset=offset, limit=limit)
+
+        with timed("report log"):
+            report = build_log_report(righe, msg_df, primo=offset + 1, eliminati=eliminati, indice=indice)
+        st.dataframe(report, hide_index=True)
+
+        if not righe.empty:
+            num = dict(zip(righe.index, range(offset + 1, offset + 1 + len(righe))))
+            # la chiave cambia con pagina e totale: dopo un'eliminazione gli
+            # id (posizioni nel CSV) si spostano e la selezione va azzerata
+            del_log = st.multiselect(
+                "Rimuovi manualmente righe LOG della pagina (seleziona N°)",
+                options=list(righe.index),
+                format_func=lambda i: str(num[i]),
+                key=f"del_log_{offset}_{totale}"
             )
             if st.button("ELIMINA RIGHE LOG SELEZIONATE"):
-                if del_log_idx:
-                    keep = log.drop(index=[i - 1 for i in del_log_idx]).reset_index(drop=True)
-                    save_csv(keep, LOG_FILE)
+                if del_log:
+                    storage.elimina_log(righe.loc[righe.index.intersection(del_log)])
+                    st.success("Righe log eliminate")
+                    st.rerun()
+
+            if any(v for v in filtri.values()):
+                conferma = st.checkbox(f"Confermo: elimina tutte le {totale} righe filtrate")
+                if st.button("ELIMINA RIGHE LOG FILTRATE") and conferma:
+                    storage.elimina_log(storage.query_log(**filtri))
                     st.success("Righe log eliminate")
                     st.rerun()
 
         c1, c2, c3 = st.columns(3)
-        with c1:
-            st.download_button("SCARICA CSV", log.to_csv(index=False), "report.csv")
-        with c2:
-            st.download_button("SCARICA EXCEL", excel_bytes(log), "report.xlsx")
         with c3:
             if st.button("PULISCI LOG"):
-                save_csv(log.iloc[0:0], LOG_FILE)
+                storage.save("log", pd.DataFrame(columns=LOG_COLS))
                 st.success("Log pulito")
                 st.rerun()
             if st.button("LOGOUT", key="logout_report"):
                 st.session_state["admin_ok"] = False
                 st.rerun()
 
+        st.markdown("---")
+
+        st.header("EXPORT")
+        st.caption("Il file viene generato solo su richiesta, con i filtri scelti.")
+
+        with st.form("export"):
+            c1, c2 = st.columns(2)
+            with c1:
+                exp_dati = st.radio("DATI", ["LOG", "MESSAGGI"], horizontal=True)
+                exp_dal = st.date_input("DAL", value=None, format="DD/MM/YYYY", key="exp_dal")
+                exp_pdv = st.selectbox("PDV", etichette_pdv, index=None, placeholder="Tutti", key="exp_pdv")
+            with c2:
+                exp_formato = st.radio("FORMATO", ["CSV", "EXCEL"], horizontal=True)
+                exp_al = st.date_input("AL", value=None, format="DD/MM/YYYY", key="exp_al")
+                exp_msg = st.selectbox(
+                    "MESSAGGIO", list(titoli), index=None, placeholder="Tutti",
+                    format_func=lambda x: titoli.get(x, x), key="exp_msg"
+                )
+            if st.form_submit_button("PREPARA EXPORT"):
+                vecchio = st.session_state.pop("export_file", None)
+                if vecchio and os.path.exists(vecchio[0]):
+                    os.remove(vecchio[0])
+                with timed(f"export {exp_dati.lower()} {exp_formato.lower()}"):
+                    st.session_state["export_file"] = prepara_export(
+                        storage, exp_dati, exp_formato, exp_dal, exp_al,
+                        indice.id_per_etichetta.get(exp_pdv), exp_msg
+                    )
+
+        exp = st.session_state.get("export_file")
+        if exp and os.path.exists(exp[0]):
+            with open(exp[0], "rb") as f:
+                st.download_button("SCARICA EXPORT", f, exp[1])
+
+        st.markdown("---")
+
+        st.header("IMMAGINI PER PDV")
+        st.caption("ZIP con una cartella per PDV e i messaggi attivi nel giorno, come immagini.")
+        zip_giorno = st.date_input("GIORNO", format="DD/MM/YYYY", key="zip_giorno")
+        if st.button("PREPARA ZIP IMMAGINI"):
+            vecchio = st.session_state.pop("zip_file", None)
+            if vecchio and os.path.exists(vecchio[0]):
+                os.remove(vecchio[0])
+            barra = st.progress(0.0, text="Preparazione...")
+            path = file_export("immagini_", ".zip")
+            with timed("export zip immagini"):
+                n_pdv, n_img = zip_immagini_pdv(
+                    storage.snapshot(zip_giorno), path,
+                    lambda fatto, totale, testo: barra.progress(fatto / totale, text=testo)
+                )
+            barra.empty()
+            st.session_state["zip_file"] = (
+                path, f"immagini_{zip_giorno:%Y%m%d}.zip", f"{n_pdv} PDV, {n_img} messaggi"
+            )
+
+        zf = st.session_state.get("zip_file")
+        if zf and os.path.exists(zf[0]):
+            st.caption(zf[2])
+            with open(zf[0], "rb") as f:
+                st.download_button("SCARICA ZIP", f, zf[1], mime="application/zip")
+
+    # ================= DIAGNOSTICA =================
+    with tab_diagnostica:
+        metriche = get_metriche()
+        st.header("TEMPI PER FASE")
+        st.caption(f"Ultimi {metriche.finestra} campioni per fase, dal {metriche.dal}")
+        st.dataframe(metriche.riepilogo().round(2), hide_index=True)
+
+        cache = get_data_cache().stats()
+        contatori = dict(metriche.contatori)
+        contatori["cache hit"] = cache["hit"]
+        contatori["cache miss"] = cache["miss"]
+        contatori["file in cache"] = cache["file"]
+        st.header("CONTATORI")
+        st.dataframe(pd.DataFrame(contatori.items(), columns=["contatore", "valore"]), hide_index=True)
+
+        st.header("SNAPSHOT DI OGGI")
+        st.caption("Messaggi attivi per PDV, letti dalla pagina dipendenti")
+        snap = storage.snapshot(datetime.now().date()).stats()
+        st.dataframe(pd.DataFrame(snap.items(), columns=["voce", "valore"]).astype(str), hide_index=True)
+
+        st.header("RERUN LENTI")
+        st.caption(f"Rerun oltre {RERUN_LENTO_S:g} s, registrati in {RERUN_LENTI_FILE}")
+        if os.path.exists(RERUN_LENTI_FILE):
+            with open(RERUN_LENTI_FILE, encoding="utf-8") as f:
+                ultimi = deque(f, maxlen=20)
+            st.dataframe(pd.json_normalize([json.loads(x) for x in reversed(ultimi)]), hide_index=True)
+
+        if st.button("AZZERA METRICHE"):
+            metriche.azzera()
+            st.rerun()
+
 
 # =========================================================
 # DIPENDENTI
@@ -571,12 +2714,13 @@ def dipendenti():
     st.markdown("<h1 style='text-align:center;'>INDICAZIONI OPERATIVE</h1>", unsafe_allow_html=True)
     st.markdown("<h3 style='text-align:center;'>SELEZIONA IL TUO PDV</h3>", unsafe_allow_html=True)
 
-    pdv_df = load_csv(PDV_FILE, ["ID", "PDV"])
-    if pdv_df.empty:
+    storage = get_storage()
+    indice = storage.indice_pdv()
+    if not len(indice):
         st.warning("Archivio PDV vuoto")
         return
 
-    scelta = st.selectbox("", pdv_df["pdv_nome"], index=None, placeholder="Digita la città...")
+    testo = st.text_input("", placeholder="Digita la città...", key="pdv_cerca")
 
     st.markdown(
         "<p style='text-align:center;'><b>"
@@ -585,28 +2729,29 @@ def dipendenti():
         unsafe_allow_html=True
     )
 
-    if not scelta:
+    # al telefono arrivano solo i PDV che corrispondono a quanto digitato
+    trovati = indice.cerca(testo)
+    if testo and not trovati:
+        st.warning("Nessun PDV trovato")
+    if not trovati:
         return
 
-    pdv_id = pdv_df.loc[pdv_df["pdv_nome"] == scelta, "pdv_id"].values[0]
-    pdv_id = str(pdv_id).strip()
-
-    msg_df = load_csv(MSG_FILE, ["msg", "inizio", "fine", "pdv_ids", "file"])
-    oggi = datetime.now().date()
-    mostrati = []
+    etichetta = st.selectbox(
+        "",
+        [indice.etichetta(x) for x in trovati],
+        index=0 if len(trovati) == 1 else None,
+        placeholder="Seleziona il tuo PDV"
+    )
+    if not etichetta:
+        return
 
-    for _, r in msg_df.iterrows():
-        ids = [x.strip() for x in (r["pdv_ids"] or "").splitlines() if x.strip()]
-        if pdv_id in ids:
-            try:
-                di = datetime.strptime(r["inizio"], "%d-%m-%Y").date()
-                df = datetime.strptime(r["fine"], "%d-%m-%Y").date()
-                if di <= oggi <= df:
-                    mostrati.append(r)
-            except Exception:
-                pass
+    # l'etichetta serve solo a scegliere: nel log id (chiave) e nome del PDV
+    pdv_id = indice.id_per_etichetta[etichetta]
+    nome_pdv = indice.nome_per_id[pdv_id]
 
-    log_df = load_csv(LOG_FILE, ["data", "pdv", "msg"])
+    oggi = datetime.now().date()
+    with timed("messaggi pdv"):
+        mostrati = [r for _, r in storage.messaggi_pdv(pdv_id, oggi).iterrows()]
 
     # ===== MESSAGGIO GENERICO =====
     if not mostrati:
@@ -617,17 +2762,18 @@ def dipendenti():
         """, unsafe_allow_html=True)
 
         if st.checkbox("Spunta CONFERMA DI PRESENZA"):
-            new = pd.DataFrame([[now_str(), scelta, "PRESENZA"]], columns=log_df.columns)
-            save_csv(pd.concat([log_df, new], ignore_index=True), LOG_FILE)
+            # la spunta resta attiva nei rerun: una sola presenza per PDV e giorno
+            if not storage.gia_registrato(pdv_id, "PRESENZA", oggi):
+                registra_log(pdv_id, nome_pdv, "PRESENZA")
             st.success("Presenza registrata")
 
         return
 
-        # ===== MESSAGGI OPERATIVI =====
+    # ===== MESSAGGI OPERATIVI =====
     for i, r in enumerate(mostrati):
 
         # 🖼️ RENDER IMMAGINE
-                st.markdown(f"""
+        st.markdown(f"""
                 <div lang="it" translate="no" style="
                 background-color: white;
                 padding: 25px;
@@ -649,73 +2795,74 @@ def dipendenti():
 
                <hr style="margin:15px 0; border:none; border-top:3px solid #dddddd;">
 
-                {r["msg"]}
+                {r["card"]}
 
                  </div>
                 """, unsafe_allow_html=True)
-                
-        # ===== ALLEGATO =====
-    if r["file"]:
-        path = os.path.join(UPLOAD_DIR, r["file"])
-        if os.path.exists(path):
-    
-                    # Immagine extra
-                    if not r["file"].lower().endswith(".pdf"):
-                        st.image(path)
-    
-                    # PDF scaricabile
-                    if r["file"].lower().endswith(".pdf"):
-                        with open(path, "rb") as f:
-                            st.download_button(
-                                label="Scarica allegato PDF",
-                                data=f.read(),
-                                file_name=r["file"]
-                            )
-
-    # ===== CHECKBOX =====
-    lettura = st.checkbox(
-        "Spunta di PRESA VISIONE",
-        key=f"l_{pdv_id}_{i}"
-    )
-
-    presenza = st.checkbox(
-        "Spunta CONFERMA DI PRESENZA",
-        key=f"p_{pdv_id}_{i}"
-    )
-
-    if lettura and presenza:
 
-        gia_registrato = (
-            (log_df["pdv"] == scelta) &
-            (log_df["msg"] == r["msg"])
-        ).any()
+        # ===== LINK =====
+        # filtro anche qui: link derivati prima del controllo sugli schemi
+        for link in json.loads(r["link"] or "[]"):
+            if url_ammesso(link["url"]):
+                st.link_button(link["label"], link["url"])
 
-        if not gia_registrato:
+        # ===== ALLEGATO =====
+        if r["file"]:
+            path = percorso_allegato(r["file"])
+            sig = file_signature(path)
+            if sig is not None:
+
+                # Immagine extra: variante per schermo, originale su richiesta
+                if not r["file"].lower().endswith(".pdf"):
+                    st.image(variante_allegato(r["file"], "screen"))
+                    st.download_button(
+                        label="Scarica immagine originale",
+                        data=allegato_bytes(path, sig),
+                        file_name=nome_allegato(r["file"]),
+                        key=f"img_{pdv_id}_{i}"
+                    )
+
+                # PDF scaricabile
+                if r["file"].lower().endswith(".pdf"):
+                    st.download_button(
+                        label="Scarica allegato PDF",
+                        data=allegato_bytes(path, sig),
+                        file_name=nome_allegato(r["file"]),
+                        key=f"pdf_{pdv_id}_{i}"
+                    )
+
+        # ===== CHECKBOX =====
+        lettura = st.checkbox(
+            "Spunta di PRESA VISIONE",
+            key=f"l_{pdv_id}_{i}"
+        )
 
-            new_row = pd.DataFrame(
-                [[now_str(), scelta, r["msg"]]],
-                columns=log_df.columns
-            )
+        presenza = st.checkbox(
+            "Spunta CONFERMA DI PRESENZA",
+            key=f"p_{pdv_id}_{i}"
+        )
 
-            updated_df = pd.concat(
-                [log_df, new_row],
-                ignore_index=True
-            )
+        if lettura and presenza:
 
-            save_csv(updated_df, LOG_FILE)
-            st.success("Registrato")
+            if not storage.gia_registrato(pdv_id, r["id"]):
+                registra_log(pdv_id, nome_pdv, r["id"])
+                st.success("Registrato")
 
-        st.markdown('</div>', unsafe_allow_html=True)
         st.markdown("---")
+
     st.link_button("HOME", HOME_URL)
 
 # =========================================================
 # ROUTER
 # =========================================================
-if st.query_params.get("admin") == "1":
-    admin()
-else:
-    dipendenti()
+# streamlit esegue lo script come __main__; l'import (bench.py) no
+if __name__ == "__main__":
+    if st.query_params.get("admin") == "1":
+        with rerun_misurato("admin"):
+            admin()
+    else:
+        with rerun_misurato("dipendenti"):
+            dipendenti()
 
 
 
@@ -0,0 +1,311 @@
+"""Benchmark dei percorsi critici dell'app su dati sintetici.
+
+Genera pdv.csv / messaggi.csv / log in una DATA_DIR temporanea (rimossa
+all'uscita) alle dimensioni richieste e misura il codice vero di app.py:
+
+    python bench.py
+    python bench.py --pdv 10000 --messaggi 2000 --righe 1000000
+    python bench.py --backend sqlite --json risultati.json
+
+L'uscita JSON (una voce per fase, tempi in secondi) serve a confrontare
+versioni diverse: stessi parametri e stesso --seed danno gli stessi dati.
+
+Prima delle misure, verifica dell'append del log da molti thread insieme
+(--martello thread): righe perse o duplicate danno exit code 1.
+"""
+import argparse
+import atexit
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+# app.py crea le cartelle dati all'import: mai toccare /var/data da qui.
+# Eseguito direttamente (o importato senza DATA_DIR) usa una cartella
+# temporanea propria, rimossa all'uscita; importato da loadtest usa la sua
+if __name__ == "__main__" or "DATA_DIR" not in os.environ:
+    DATA_DIR = tempfile.mkdtemp(prefix="bench_pdv_")
+    os.environ["DATA_DIR"] = DATA_DIR
+    atexit.register(shutil.rmtree, DATA_DIR, ignore_errors=True)
+
+import pandas as pd
+
+import app
+
+CATENE = ["ESSELUNGA", "CARREFOUR", "COOP", "CONAD", "IPER", "PAM", "LIDL", "BENNET"]
+CITTA = [
+    "Torino", "Milano", "Biella", "Nichelino", "Collegno", "Novara", "Asti", "Cuneo",
+    "Alba", "Ivrea", "Burolo", "Pinerolo", "Genova", "Savona", "Massa", "Porcari",
+]
+
+
+def genera_pdv(n, seed=0):
+    rnd = random.Random(seed)
+    return pd.DataFrame({
+        "pdv_id": [str(1000 + i) for i in range(n)],
+        "pdv_nome": [f"{rnd.choice(CATENE)} {rnd.choice(CITTA)} {i}" for i in range(n)],
+    })
+
+
+def genera_msg(n, pdv_ids=(), seed=1):
+    rnd = random.Random(seed)
+    pdv_ids = list(pdv_ids)
+    oggi = date.today()
+    rows = []
+    for i in range(n):
+        inizio = oggi + timedelta(days=rnd.randint(-60, 5))
+        fine = inizio + timedelta(days=rnd.randint(0, 30))
+        link = "<a href='https://youtu.be/promo'>video</a>" if i % 5 == 0 else ""
+        html_msg = f"<p><strong>Promo {i}</strong></p><p>{'testo ' * rnd.randint(10, 80)}{link}</p>"
+        if i % 10 == 1:
+            # campagna di catena
+            target = [f"@{rnd.choice(CATENE)}"]
+        elif i % 10 == 2 and pdv_ids:
+            k = rnd.randrange(len(pdv_ids))
+            target = [f"{pdv_ids[k]}-{pdv_ids[min(k + rnd.randint(10, 500), len(pdv_ids) - 1)]}"]
+        else:
+            target = rnd.sample(pdv_ids, min(len(pdv_ids), rnd.randint(1, 200)))
+        rows.append([
+            html_msg,
+            inizio.strftime("%d-%m-%Y"),
+            fine.strftime("%d-%m-%Y"),
+            "\n".join(target),
+            "",
+            f"m{i:011d}",
+            app.hash_msg(html_msg),
+        ])
+    return app.deriva_msg(pd.DataFrame(rows, columns=app.MSG_COLS))
+
+
+def genera_log(n, msg_df, n_pdv=5000, seed=2):
+    rnd = random.Random(seed)
+    ids = list(msg_df["id"]) + ["PRESENZA"] * max(1, len(msg_df) // 10)
+    oggi = date.today()
+    giorni = [(oggi - timedelta(days=d)).strftime("%d-%m-%Y") for d in range(90)]
+    data = [f"{rnd.choice(giorni)} 08:{rnd.randint(0, 59):02d}:00" for _ in range(n)]
+    pdv = [rnd.randint(1, n_pdv) for _ in range(n)]
+    # PDV fittizi: id diversi da quelli di genera_pdv
+    return pd.DataFrame({
+        "data": data,
+        "pdv": [f"PDV {k}" for k in pdv],
+        "msg": rnd.choices(ids, k=n),
+        "pdv_id": [f"P{k}" for k in pdv],
+    })
+
+
+def misura(nome, fn, ripetizioni, righe=None):
+    tempi = []
+    for _ in range(ripetizioni):
+        t0 = time.perf_counter()
+        fn()
+        tempi.append(time.perf_counter() - t0)
+    ris = {
+        "fase": nome,
+        "min": min(tempi),
+        "mediana": statistics.median(tempi),
+        "max": max(tempi),
+        "ripetizioni": ripetizioni,
+    }
+    if righe:
+        ris["righe"] = righe
+        ris["righe_s"] = righe / ris["min"] if ris["min"] else None
+    print(f"{nome:<24} min {ris['min']:9.4f}s  mediana {ris['mediana']:9.4f}s", file=sys.stderr)
+    return ris
+
+
+def martella_log(storage, thread=32, righe=50):
+    # append concorrenti sullo stesso log, una riga alla volta: alla fine
+    # ogni riga scritta deve esserci esattamente una volta
+    prima = len(storage.load("log"))
+    errori = []
+
+    def scrivi(t):
+        try:
+            for i in range(righe):
+                storage.append("log", [app.now_str(), f"MARTELLO {t}", f"m{i}", f"M{t}"])
+        except Exception as e:
+            errori.append(f"thread {t}: {e}")
+
+    th = [threading.Thread(target=scrivi, args=(t,)) for t in range(thread)]
+    for x in th:
+        x.start()
+    for x in th:
+        x.join()
+    nuove = storage.load("log").iloc[prima:]
+    scritte = nuove[nuove["pdv"].astype(str).str.startswith("MARTELLO ")]
+    conteggi = scritte.groupby(["pdv", "msg"], observed=True).size()
+    return {
+        "thread": thread,
+        "righe_attese": thread * righe,
+        "righe_scritte": len(scritte),
+        "righe_distinte": len(conteggi),
+        "righe_duplicate": int((conteggi - 1).sum()),
+        "errori": errori[:20],
+    }
+
+
+def crea_storage(backend):
+    if backend == "sqlite":
+        return app.SqliteStorage(app.DB_FILE)
+    storage = app.CsvStorage()
+    storage.partiziona_log()
+    return storage
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pdv", type=int, default=10000)
+    ap.add_argument("--messaggi", type=int, default=2000)
+    ap.add_argument("--righe", type=int, default=1000000)
+    ap.add_argument("--export", type=int, default=100000, help="righe del report nell'export Excel")
+    ap.add_argument("--checkin", type=int, default=500, help="append del log misurati")
+    ap.add_argument("--martello", type=int, default=32, help="thread della verifica append concorrenti")
+    ap.add_argument("--ripetizioni", type=int, default=3)
+    ap.add_argument("--backend", choices=["csv", "sqlite"], default="csv")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--json", help="file di uscita (default: stdout)")
+    args = ap.parse_args()
+    rip = args.ripetizioni
+
+    # ----- dati sintetici, scritti con lo storage dell'app
+    pdv_df = genera_pdv(args.pdv, args.seed)
+    msg_df = genera_msg(args.messaggi, pdv_df["pdv_id"], args.seed + 1)
+    log_df = genera_log(args.righe, msg_df, args.pdv, args.seed + 2)
+    storage = crea_storage(args.backend)
+    storage.save("pdv", pdv_df)
+    storage.save("msg", msg_df)
+    storage.save("log", log_df)
+
+    # ----- verifica: append da molti thread, nessuna riga persa o duplicata
+    verifica = martella_log(storage, args.martello)
+    ok = (
+        verifica["righe_distinte"] == verifica["righe_attese"]
+        and not verifica["righe_duplicate"] and not verifica["errori"]
+    )
+    print(
+        f"{'martello log':<24} {verifica['righe_distinte']} di {verifica['righe_attese']} righe "
+        f"da {verifica['thread']} thread, duplicate {verifica['righe_duplicate']}",
+        file=sys.stderr
+    )
+    if not ok:
+        json.dump(verifica, sys.stderr, indent=2)
+        sys.exit(1)
+
+    oggi = date.today()
+    campione = random.Random(args.seed).sample(list(pdv_df["pdv_id"]), min(200, len(pdv_df)))
+    risultati = []
+
+    # ----- pagina dipendenti: ricerca del PDV e messaggi attivi
+    risultati.append(misura("indice_pdv", lambda: app.IndicePdv(storage.load("pdv")), rip, args.pdv))
+    indice = storage.indice_pdv()
+    risultati.append(misura(
+        "cerca_pdv x200",
+        lambda: [indice.cerca(indice.nome_per_id[x][:6]) for x in campione],
+        rip
+    ))
+
+    def compila_bersagli():
+        bersagli = app.Bersagli(storage.indice_pdv())
+        return [bersagli.bits(x) for x in msg_df["pdv_ids"]]
+
+    risultati.append(misura("bersagli (compila tutti)", compila_bersagli, rip, args.messaggi))
+    bersagli = storage.bersagli()
+    risultati.append(misura("snapshot_giorno", lambda: app.SnapshotGiorno(oggi, msg_df, bersagli), rip, args.messaggi))
+    risultati.append(misura(
+        "messaggi_pdv x200",
+        lambda: [storage.messaggi_pdv(x, oggi) for x in campione],
+        rip
+    ))
+
+    # ----- check-in: append di una riga di log
+    n = args.checkin
+    risultati.append(misura(
+        f"append_log x{n}",
+        lambda: [storage.append("log", [app.now_str(), f"BENCH {i}", "PRESENZA", f"B{i}"]) for i in range(n)],
+        1,
+        n
+    ))
+
+    # ----- stesso numero di check-in da 20 sessioni concorrenti, via ScrittoreLog
+    scrittore = app.ScrittoreLog(storage)
+
+    def raffica(sessioni=20):
+        def sessione(t):
+            for i in range(n // sessioni):
+                scrittore.scrivi([app.now_str(), f"RAFFICA {t}", f"m{i}", f"R{t}"])
+        th = [threading.Thread(target=sessione, args=(t,)) for t in range(sessioni)]
+        for x in th:
+            x.start()
+        for x in th:
+            x.join()
+
+    risultati.append(misura(f"scrittore_log x{n} (20 sessioni)", raffica, 1, n))
+    scrittore.chiudi()
+    risultati.append(misura("gia_registrato", lambda: storage.gia_registrato("B1", "PRESENZA"), rip))
+
+    # ----- tab REPORT
+    risultati.append(misura("load_log", lambda: storage.load("log"), rip, args.righe))
+    memoria = {
+        "testo": log_df.memory_usage(deep=True).sum() / 2 ** 20,
+        "tipizzato": storage.load("log").memory_usage(deep=True).sum() / 2 ** 20,
+    }
+    print(f"{'memoria log':<24} testo {memoria['testo']:.1f} MB  tipizzato {memoria['tipizzato']:.1f} MB", file=sys.stderr)
+    risultati.append(misura("stato_messaggi", lambda: app.stato_messaggi(msg_df), rip, args.messaggi))
+    risultati.append(misura("deriva_msg", lambda: app.deriva_msg(msg_df.assign(titolo="")), 1, args.messaggi))
+    risultati.append(misura("build_log_report", lambda: app.build_log_report(log_df, msg_df), rip, args.righe))
+    risultati.append(misura("copertura (ricalcolo)", lambda: storage.copertura(ricalcola=True), rip, args.righe))
+    risultati.append(misura("copertura_giorno", lambda: storage.copertura_giorno(oggi), rip))
+    risultati.append(misura("pagina_log", lambda: storage.pagina_log(offset=args.righe // 2, limit=100), rip))
+
+    # ----- export Excel (write-only, a blocchi come prepara_export)
+    report = app.build_log_report(log_df.iloc[:args.export], msg_df).drop(columns="N°")
+    path = os.path.join(app.DATA_DIR, "bench_export.xlsx")
+    blocchi = lambda: (report.iloc[i:i + app.EXPORT_CHUNK] for i in range(0, len(report), app.EXPORT_CHUNK))
+    risultati.append(misura(
+        "scrivi_excel",
+        lambda: app.scrivi_excel(blocchi(), path, list(report.columns)),
+        1,
+        len(report)
+    ))
+
+    # ----- immagine del messaggio: render Pillow e lettura dalla cache su disco
+    html_msg = msg_df["msg"].iloc[0]
+    risultati.append(misura("render_msg_image", lambda: app.render_msg_image(html_msg), rip))
+    app.msg_image_png(html_msg)
+    risultati.append(misura("msg_image_png (cache)", lambda: app.msg_image_png(html_msg), rip))
+
+    # ----- ZIP immagini per PDV del giorno: render in parallelo, poi dalla cache
+    snap = storage.snapshot(oggi)
+    path = os.path.join(app.DATA_DIR, "bench_immagini.zip")
+    risultati.append(misura("zip_immagini_pdv", lambda: app.zip_immagini_pdv(snap, path), 1, len(snap.attivi)))
+    risultati.append(misura("zip_immagini_pdv (cache)", lambda: app.zip_immagini_pdv(snap, path), 1, len(snap.attivi)))
+
+    uscita = {
+        "parametri": vars(args),
+        "ambiente": {
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "macchina": platform.machine(),
+        },
+        "quando": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "risultati": risultati,
+        "memoria_log_mb": memoria,
+        "verifica_append": verifica,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(uscita, f, indent=2)
+    else:
+        json.dump(uscita, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
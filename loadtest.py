@@ -0,0 +1,225 @@
+"""Test di carico: N sessioni dipendenti concorrenti + sessioni admin.
+
+Guida app.py senza browser con streamlit.testing (AppTest), contro una
+DATA_DIR temporanea (rimossa all'uscita) popolata con i generatori di bench.py:
+
+    python loadtest.py
+    python loadtest.py --sessioni 500 --concorrenza 50 --admin 10
+    python loadtest.py --backend sqlite --json carico.json
+
+Ogni sessione dipendente cerca il proprio PDV, lo seleziona e spunta
+tutte le caselle; le sessioni admin aprono il REPORT. Alla fine il log
+viene confrontato con le righe attese: righe perse o duplicate, errori
+o eccezioni danno exit code 1, così il test può bloccare un rilascio.
+"""
+import argparse
+import atexit
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+# DATA_DIR di questo test, usata anche da bench (importato sotto)
+DATA_DIR = tempfile.mkdtemp(prefix="loadtest_pdv_")
+os.environ["DATA_DIR"] = DATA_DIR
+atexit.register(shutil.rmtree, DATA_DIR, ignore_errors=True)
+
+from unittest.mock import MagicMock
+
+import pandas as pd
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest
+from streamlit.testing.v1 import app_test, local_script_runner
+
+import bench
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+ADMIN_PASSWORD = "GianAri2026"
+
+
+def runtime_condiviso():
+    # AppTest è pensato per una sessione alla volta. Per averne molte in
+    # parallelo nello stesso processo, come nel server vero:
+    # - AppTest imposta e poi azzera Runtime._instance a ogni run: un
+    #   runtime finto unico resta valido per tutto il test;
+    # - ogni run compilerebbe app.py con una propria ScriptCache, e
+    #   compile() concorrenti falliscono su Python 3.11: la cache dello
+    #   script è unica, come quella del server.
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime._instance = runtime
+    app_test.Runtime = type("RuntimeAppTest", (), {"_instance": None})
+    cache_script = ScriptCache()
+    local_script_runner.ScriptCache = lambda: cache_script
+
+
+def percentili(tempi):
+    if not tempi:
+        return {}
+    q = pd.Series(tempi).quantile([0.5, 0.9, 0.99])
+    return {"n": len(tempi), "p50": q[0.5], "p90": q[0.9], "p99": q[0.99], "max": max(tempi)}
+
+
+class Raccolta:
+    # tempi per passo ed errori, da tutti i thread
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.tempi = {}
+        self.errori = []
+
+    def tempo(self, passo, dt):
+        with self._lock:
+            self.tempi.setdefault(passo, []).append(dt)
+
+    def errore(self, chi, e):
+        with self._lock:
+            self.errori.append(f"{chi}: {e}")
+
+
+def passo(raccolta, nome, at, timeout):
+    t0 = time.perf_counter()
+    at.run(timeout=timeout)
+    raccolta.tempo(nome, time.perf_counter() - t0)
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+
+
+def sessione_dipendente(nome, raccolta, timeout):
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    t0 = time.perf_counter()
+    passo(raccolta, "apertura", at, timeout)
+    at.text_input(key="pdv_cerca").input(nome)
+    passo(raccolta, "ricerca", at, timeout)
+    if at.selectbox[0].value != nome:
+        at.selectbox[0].select(nome)
+        passo(raccolta, "selezione", at, timeout)
+    for c in at.checkbox:
+        c.check()
+    passo(raccolta, "conferma", at, timeout)
+    # un altro rerun con le spunte ancora attive (come un refresh o un
+    # qualsiasi widget toccato): non deve registrare altre righe
+    passo(raccolta, "rerun", at, timeout)
+    raccolta.tempo("sessione dipendente", time.perf_counter() - t0)
+
+
+def sessione_admin(raccolta, timeout):
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    at.query_params["admin"] = "1"
+    t0 = time.perf_counter()
+    passo(raccolta, "admin apertura", at, timeout)
+    at.text_input[0].input(ADMIN_PASSWORD)
+    passo(raccolta, "admin report", at, timeout)
+    raccolta.tempo("sessione admin", time.perf_counter() - t0)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sessioni", type=int, default=500, help="sessioni dipendenti (una per PDV)")
+    ap.add_argument("--senza-messaggi", type=int, default=20, help="altre sessioni, di PDV senza messaggi (PRESENZA)")
+    ap.add_argument("--admin", type=int, default=10, help="sessioni admin mescolate alle altre")
+    ap.add_argument("--concorrenza", type=int, default=50, help="sessioni attive insieme")
+    ap.add_argument("--messaggi", type=int, default=200)
+    ap.add_argument("--righe", type=int, default=100000, help="log preesistente")
+    ap.add_argument("--backend", choices=["csv", "sqlite"], default="csv")
+    ap.add_argument("--timeout", type=float, default=120)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--json", help="file di uscita (default: stdout)")
+    args = ap.parse_args()
+    os.environ["STORAGE_BACKEND"] = args.backend
+    runtime_condiviso()
+
+    # ----- dati: un PDV per sessione; il log preesistente usa PDV fittizi
+    pdv_df = bench.genera_pdv(args.sessioni, args.seed)
+    msg_df = bench.genera_msg(args.messaggi, pdv_df["pdv_id"], args.seed + 1)
+    # PDV fuori da catene e intervalli dei messaggi: nessun messaggio attivo
+    n = len(pdv_df)
+    pdv_df = pd.concat([pdv_df, pd.DataFrame({
+        "pdv_id": [str(1000 + n + i) for i in range(args.senza_messaggi)],
+        "pdv_nome": [f"NEGOZIO Senza {i}" for i in range(args.senza_messaggi)],
+    })], ignore_index=True)
+    storage = bench.crea_storage(args.backend)
+    storage.save("pdv", pdv_df)
+    storage.save("msg", msg_df)
+    storage.save("log", bench.genera_log(args.righe, msg_df, args.sessioni, args.seed + 2))
+    prima = len(storage.load("log"))
+
+    # righe attese: una per messaggio attivo, oppure una PRESENZA
+    oggi = date.today()
+    attese = []
+    for pdv_id, nome in zip(pdv_df["pdv_id"], pdv_df["pdv_nome"]):
+        ids = list(storage.messaggi_pdv(pdv_id, oggi)["id"]) or ["PRESENZA"]
+        attese += [(pdv_id, x) for x in ids]
+
+    lavori = [("dipendente", nome) for nome in pdv_df["pdv_nome"]] + [("admin", None)] * args.admin
+    random.Random(args.seed).shuffle(lavori)
+    raccolta = Raccolta()
+
+    def esegui(lavoro):
+        tipo, nome = lavoro
+        try:
+            if tipo == "admin":
+                sessione_admin(raccolta, args.timeout)
+            else:
+                sessione_dipendente(nome, raccolta, args.timeout)
+        except Exception as e:
+            raccolta.errore(nome or "admin", e)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concorrenza) as pool:
+        list(pool.map(esegui, lavori))
+    durata = time.perf_counter() - t0
+
+    # ----- verifica del log: righe perse o duplicate
+    log = storage.load("log")
+    nuove = log.iloc[prima:]
+    scritte = nuove[nuove["pdv_id"].isin(set(pdv_df["pdv_id"]))]
+    conteggi = scritte.groupby(["pdv_id", "msg"], observed=True).size()
+    attese_idx = pd.MultiIndex.from_tuples(attese, names=["pdv_id", "msg"])
+    perse = attese_idx.difference(conteggi.index)
+    duplicate = conteggi[conteggi > 1]
+    inattese = conteggi.index.difference(attese_idx)
+
+    uscita = {
+        "parametri": vars(args),
+        "durata_s": durata,
+        "sessioni_s": len(lavori) / durata,
+        "checkin_s": len(scritte) / durata,
+        "righe_attese": len(attese),
+        "righe_scritte": len(scritte),
+        "righe_perse": len(perse),
+        "righe_duplicate": int((duplicate - 1).sum()),
+        "righe_inattese": len(inattese),
+        "errori": raccolta.errori[:50],
+        "n_errori": len(raccolta.errori),
+        "latenze_s": {k: percentili(v) for k, v in sorted(raccolta.tempi.items())},
+    }
+    testo = json.dumps(uscita, indent=2, default=str)
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(testo)
+    else:
+        print(testo)
+
+    print(
+        f"{len(lavori)} sessioni in {durata:.1f}s ({uscita['sessioni_s']:.1f}/s) — "
+        f"righe attese {len(attese)}, perse {len(perse)}, duplicate {uscita['righe_duplicate']}, "
+        f"errori {len(raccolta.errori)}",
+        file=sys.stderr
+    )
+    ok = not (len(perse) or len(duplicate) or len(inattese) or raccolta.errori)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Append concorrenti del log: ogni riga scritta c'è esattamente una volta.
+
+    python -m pytest -q tests
+
+app.py crea le cartelle dati all'import: DATA_DIR temporanea impostata
+prima, rimossa a fine modulo.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from collections import Counter
+
+DATA_DIR = tempfile.mkdtemp(prefix="test_log_")
+os.environ["DATA_DIR"] = DATA_DIR
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+import pytest
+
+import app
+
+THREAD = 16
+RIGHE = 50
+
+
+@pytest.fixture(scope="module", autouse=True)
+def data_dir():
+    yield DATA_DIR
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+
+@pytest.fixture(params=["csv", "sqlite"])
+def storage(request, tmp_path):
+    # log vuoto per ogni test: partizioni CSV ripulite, db SQLite nuovo
+    shutil.rmtree(app.LOG_DIR, ignore_errors=True)
+    if request.param == "sqlite":
+        return app.SqliteStorage(str(tmp_path / "test.db"))
+    return app.CsvStorage()
+
+
+def in_parallelo(scrivi):
+    # scrivi(t) in THREAD thread insieme; eccezioni raccolte e rilanciate
+    errori = []
+
+    def esegui(t):
+        try:
+            scrivi(t)
+        except Exception as e:
+            errori.append(e)
+
+    th = [threading.Thread(target=esegui, args=(t,)) for t in range(THREAD)]
+    for x in th:
+        x.start()
+    for x in th:
+        x.join()
+    if errori:
+        raise errori[0]
+
+
+def riga(t, i):
+    return [app.now_str(), f"PDV {t}", f"m{i}", f"P{t}"]
+
+
+def attese():
+    return Counter((f"P{t}", f"m{i}") for t in range(THREAD) for i in range(RIGHE))
+
+
+def scritte(log):
+    return Counter(zip(log["pdv_id"].astype(str), log["msg"].astype(str)))
+
+
+def test_append_csv_rows(tmp_path):
+    path = str(tmp_path / "righe.csv")
+    in_parallelo(lambda t: [app.append_csv_rows(path, [[t, i]], ["t", "i"]) for i in range(RIGHE)])
+    df = pd.read_csv(path, dtype=str)
+    assert list(df.columns) == ["t", "i"]
+    assert Counter(zip(df["t"], df["i"])) == Counter(
+        (str(t), str(i)) for t in range(THREAD) for i in range(RIGHE)
+    )
+
+
+def test_append_many(storage):
+    in_parallelo(lambda t: [storage.append_many("log", [riga(t, i)]) for i in range(RIGHE)])
+    assert scritte(storage.load("log")) == attese()
+
+
+def test_scrittore_log(storage):
+    scrittore = app.ScrittoreLog(storage)
+    try:
+        in_parallelo(lambda t: [scrittore.scrivi(riga(t, i)) for i in range(RIGHE)])
+    finally:
+        scrittore.chiudi()
+    assert scritte(storage.load("log")) == attese()
+    # chiavi in memoria allineate alle righe scritte a lotti
+    assert storage.gia_registrato(f"P{THREAD - 1}", f"m{RIGHE - 1}")